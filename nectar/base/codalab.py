@@ -1,15 +1,43 @@
 """Utilities for interacting with codalab."""
 import collections
+import hashlib
+import itertools
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 
 from .. import log
 
 DOCKER_IMAGE = 'robinjia/robinjia-codalab:2.1.1'
+CL = 'cl'  # The CodaLab CLI executable (may point to a stub for testing)
+FETCH_CACHE_DIR = os.path.expanduser('~/.nectar/codalab_cache')
+UUID_RE = re.compile('^0x[0-9a-f]{32}$')
+FINAL_STATES = ('ready', 'failed', 'killed')
+
+def _call_cl(call_args, quiet=False):
+  """Run a cl command and return the last line it prints (usually a uuid)."""
+  out = subprocess.check_output(call_args)
+  lines = [x.strip() for x in out.splitlines() if x.strip()]
+  uuid = lines[-1] if lines else None
+  if not quiet:
+    log('cl %s: %s' % (call_args[1], uuid))
+  return uuid
 
 def run(cmd, deps, name, description, queue='john', host=None, cpus=1,
         docker_image=DOCKER_IMAGE, is_theano=False, omp_num_threads=1,
-        dry_run=False):
+        dry_run=False, executor=None):
+  """Submit a run bundle; return its uuid (None on a dry run).
+
+  If executor (a localrun.LocalExecutor) is provided, run the command on
+  this machine instead of submitting it to CodaLab.  The queue, host and
+  docker image are then ignored.
+  """
   params = collections.OrderedDict()
   if host:
     params['--request-queue'] = 'host=%s' % host
@@ -23,19 +51,220 @@ def run(cmd, deps, name, description, queue='john', host=None, cpus=1,
   if is_theano:
     prefix = 'OMP_NUM_THREADS=%d THEANO_FLAGS=blas.ldflags=-lopenblas' % omp_num_threads
     cmd = prefix + ' ' + cmd
-  call_args = ['cl', 'run'] + deps + [cmd] + param_list
+  if executor:
+    if dry_run:
+      log('Dry run (local): %s' % cmd)
+      return None
+    return executor.submit(cmd, deps, name, description, cpus=cpus,
+                           omp_num_threads=omp_num_threads)
+  call_args = [CL, 'run'] + deps + [cmd] + param_list
   if dry_run:
     log('Dry run: %s' % str(call_args))
   else:
-    subprocess.call(call_args)
+    return _call_cl(call_args)
+
+def hash_path(filename):
+  """Compute a SHA-1 hash of the contents of a file or directory."""
+  h = hashlib.sha1()
+  if os.path.isdir(filename):
+    for root, dirs, files in os.walk(filename):
+      dirs.sort()
+      for fn in sorted(files):
+        path = os.path.join(root, fn)
+        h.update(os.path.relpath(path, filename) + '\0')
+        h.update(hash_path(path) + '\0')
+  else:
+    with open(filename, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), ''):
+        h.update(block)
+  return h.hexdigest()
+
+class UploadCache(object):
+  """A local, thread-safe map from content hash to uploaded bundle uuid."""
+  def __init__(self, cache_file):
+    self.cache_file = cache_file
+    self.lock = threading.Lock()
+    if os.path.exists(cache_file):
+      with open(cache_file) as f:
+        self.cache = json.load(f)
+    else:
+      self.cache = {}
+
+  def get(self, content_hash):
+    with self.lock:
+      return self.cache.get(content_hash)
 
-def upload(filename, name=None, description=None, dry_run=False):
-  call_args = ['cl', 'up', filename]
+  def put(self, content_hash, uuid):
+    with self.lock:
+      self.cache[content_hash] = uuid
+      tmp_file = self.cache_file + '.tmp'
+      with open(tmp_file, 'w') as f:
+        json.dump(self.cache, f, indent=2)
+      os.rename(tmp_file, self.cache_file)
+
+def upload(filename, name=None, description=None, dry_run=False,
+           cache=None):
+  """Upload a file or directory; return its bundle uuid (None on a dry run).
+
+  Args:
+    filename: path to upload.
+    name: bundle name.
+    description: bundle description.
+    dry_run: if True, only log the command.
+    cache: an UploadCache.  If provided, contents already uploaded
+        are not uploaded again; the earlier bundle's uuid is returned.
+  """
+  call_args = [CL, 'up', filename]
   if name:
     call_args.extend(['-n', name])
   if description:
     call_args.extend(['-d', description])
   if dry_run:
     log('Dry run: %s' % str(call_args))
+    return None
+  if cache:
+    content_hash = hash_path(filename)
+    uuid = cache.get(content_hash)
+    if uuid:
+      log('Skipping upload of %s, contents match bundle %s' % (filename, uuid))
+      return uuid
+  uuid = _call_cl(call_args)
+  if cache:
+    cache.put(content_hash, uuid)
+  return uuid
+
+def expand_grid(grid):
+  """Expand a dict of parameter -> list of values into a list of dicts.
+
+  Keys are expanded in sorted order (or insertion order for an OrderedDict),
+  with the last key varying fastest.
+  """
+  if isinstance(grid, collections.OrderedDict):
+    keys = list(grid)
   else:
-    subprocess.call(call_args)
+    keys = sorted(grid)
+  return [collections.OrderedDict(zip(keys, values))
+          for values in itertools.product(*[grid[k] for k in keys])]
+
+def sweep(cmd_template, grid, deps, name_template, description_template='',
+          max_parallel=8, manifest_file=None, dry_run=False, **kwargs):
+  """Submit one run for every point in a hyperparameter grid.
+
+  Templates are filled in with %-formatting using each point's parameters,
+  e.g. 'python train.py --lr %(lr)s' with grid {'lr': [0.1, 0.01]}.
+  Runs are submitted concurrently, with at most max_parallel cl processes
+  at a time.
+
+  Args:
+    cmd_template: template for the command.
+    grid: dict mapping parameter name to list of values, see expand_grid().
+    deps: list of dependencies, passed to run().
+    name_template: template for the bundle name.
+    description_template: template for the bundle description.
+    max_parallel: maximum number of concurrent submissions.
+    manifest_file: if provided, append a JSON line per submitted run.
+    dry_run: passed to run().
+    **kwargs: other arguments passed to run().
+  Returns:
+    A list of dicts with keys 'params', 'name', 'cmd' and 'uuid',
+    in the order of expand_grid(grid).
+  """
+  manifest_lock = threading.Lock()
+  def submit(params):
+    cmd = cmd_template % params
+    name = name_template % params
+    description = description_template % params
+    uuid = run(cmd, deps, name, description, dry_run=dry_run, **kwargs)
+    entry = collections.OrderedDict([
+        ('name', name), ('uuid', uuid), ('cmd', cmd), ('params', params)])
+    if manifest_file and not dry_run:
+      with manifest_lock:
+        with open(manifest_file, 'a') as f:
+          print >> f, json.dumps(entry)
+    return entry
+  points = expand_grid(grid)
+  pool = ThreadPool(max(1, min(max_parallel, len(points))))
+  try:
+    return pool.map(submit, points)
+  finally:
+    pool.close()
+    pool.join()
+
+def _fetch_cache_path(cache_dir, uuid, path):
+  """Return (entry_dir, target) of the cache entry for (uuid, path).
+
+  Each path gets its own flat entry directory, named by a hash of the path,
+  so entries never nest: fetching 'out/a.json' then 'out' must not find a
+  partial 'out' made by the first fetch.  The target keeps the basename of
+  the path.
+  """
+  path = path.strip('/')
+  if path:
+    path = os.path.normpath(path)
+  key = hashlib.sha1(
+      path.encode('utf-8') if isinstance(path, unicode) else path).hexdigest()[:16]
+  entry_dir = os.path.join(cache_dir, uuid, key)
+  return entry_dir, os.path.join(entry_dir, os.path.basename(path) or '_bundle')
+
+def fetch(bundle, path='', cache_dir=FETCH_CACHE_DIR):
+  """Download a file or directory from a bundle, with a local cache.
+
+  Bundle contents never change once a bundle has finished, so cached
+  entries are keyed by (uuid, path) and never invalidated.  Bundles that
+  are still running are downloaded to a temporary directory and not cached.
+
+  Args:
+    bundle: uuid or name of the bundle (names are resolved to uuids).
+    path: path within the bundle (default = the whole bundle).
+    cache_dir: directory for cached downloads.
+  Returns:
+    Local path to the downloaded file or directory.
+  """
+  if UUID_RE.match(bundle):
+    uuid = bundle
+  else:
+    uuid = _call_cl([CL, 'info', '-f', 'uuid', bundle], quiet=True)
+  entry_dir, target = _fetch_cache_path(cache_dir, uuid, path)
+  if os.path.exists(target):
+    return target
+  bundle_dir = os.path.dirname(entry_dir)
+  if not os.path.exists(bundle_dir):
+    try:
+      os.makedirs(bundle_dir)
+    except OSError:
+      if not os.path.isdir(bundle_dir): raise  # Another thread may have made it
+  state = _call_cl([CL, 'info', '-f', 'state', uuid], quiet=True)
+  spec = '%s/%s' % (uuid, path.strip('/')) if path.strip('/') else uuid
+  if state not in FINAL_STATES:
+    tmp_target = os.path.join(tempfile.mkdtemp(), os.path.basename(target))
+    _call_cl([CL, 'down', spec, '-o', tmp_target], quiet=True)
+    return tmp_target
+  # Download into a temporary entry, then rename the whole entry into
+  # place, so an entry directory only ever exists complete.
+  tmp_dir = tempfile.mkdtemp(dir=bundle_dir, prefix='tmp-')
+  try:
+    _call_cl([CL, 'down', spec, '-o', os.path.join(tmp_dir, os.path.basename(target))],
+             quiet=True)
+    try:
+      os.rename(tmp_dir, entry_dir)
+    except OSError:
+      if not os.path.exists(target): raise  # Else someone else fetched it first
+  finally:
+    # Already gone if renamed into place; else a failed or duplicate download
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+  return target
+
+def fetch_many(specs, cache_dir=FETCH_CACHE_DIR, max_parallel=16):
+  """Fetch many (bundle, path) pairs concurrently.
+
+  Returns:
+    A list of local paths, in the same order as specs.
+  """
+  specs = list(specs)
+  if not specs: return []
+  pool = ThreadPool(max(1, min(max_parallel, len(specs))))
+  try:
+    return pool.map(lambda x: fetch(x[0], x[1], cache_dir=cache_dir), specs)
+  finally:
+    pool.close()
+    pool.join()
@@ -0,0 +1,212 @@
+"""Run codalab-style jobs on the local machine.
+
+A LocalExecutor takes the same commands and dependencies as codalab.run(),
+and runs them as subprocesses, packing jobs onto the local cores according
+to the number of cpus each one requests.  Each job runs inside its own
+bundle directory, with its dependencies symlinked in, and leaves behind
+its outputs along with "stdout" and "stderr" files, like a CodaLab bundle.
+
+Example:
+  executor = LocalExecutor('local_bundles')
+  codalab.run('python train.py', ['data:data_dir'], 'train', '',
+              cpus=4, executor=executor)
+  executor.wait()
+"""
+import collections
+import distutils.spawn
+import json
+import multiprocessing
+import os
+import subprocess
+import threading
+import time
+import uuid as uuidlib
+
+from .. import log
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_READY = 'ready'
+STATE_FAILED = 'failed'
+
+class LocalJob(object):
+  """A single job submitted to a LocalExecutor."""
+  def __init__(self, uuid, cmd, deps, name, description, cpus, omp_num_threads):
+    self.uuid = uuid
+    self.cmd = cmd
+    self.deps = deps  # list of (key, path)
+    self.dep_uuids = []  # Earlier local jobs that must finish first
+    self.name = name
+    self.description = description
+    self.cpus = cpus
+    self.omp_num_threads = omp_num_threads
+    self.state = STATE_QUEUED
+    self.cores = []
+    self.exitcode = None
+    self.start_time = None
+    self.end_time = None
+
+  def to_dict(self):
+    d = collections.OrderedDict()
+    for k in ('uuid', 'name', 'description', 'cmd', 'cpus', 'state',
+              'exitcode', 'cores', 'start_time', 'end_time'):
+      d[k] = getattr(self, k)
+    d['deps'] = ['%s:%s' % (k, p) for k, p in self.deps]
+    return d
+
+class LocalExecutor(object):
+  """Runs jobs locally, scheduling them by their cpu requests."""
+  def __init__(self, output_dir, num_cpus=None, set_affinity=True):
+    """Create the executor.
+
+    Args:
+      output_dir: directory in which to create bundle directories.
+      num_cpus: number of cores to use (default = all of them).
+      set_affinity: if True, pin each job to its cores with taskset
+          (when taskset is available).
+    """
+    self.output_dir = output_dir
+    self.num_cpus = num_cpus or multiprocessing.cpu_count()
+    self.taskset = None
+    if set_affinity:
+      self.taskset = distutils.spawn.find_executable('taskset')
+    self.free_cores = list(range(self.num_cpus))
+    self.jobs = collections.OrderedDict()  # uuid -> LocalJob
+    self.name_to_uuid = {}
+    self.queue = []
+    self.cond = threading.Condition()
+    if not os.path.exists(output_dir):
+      os.makedirs(output_dir)
+
+  def bundle_dir(self, uuid):
+    return os.path.join(self.output_dir, uuid)
+
+  def _resolve_dep(self, dep):
+    """Resolve a "key:target" dependency to (key, local path, job uuid).
+
+    The target may be a path, or the name or uuid of an earlier local job,
+    optionally followed by a /subpath.
+    """
+    if ':' in dep:
+      key, target = dep.split(':', 1)
+    else:
+      key, target = os.path.basename(dep.rstrip('/')), dep
+    bundle, _, subpath = target.partition('/')
+    uuid = self.name_to_uuid.get(bundle, bundle)
+    if uuid in self.jobs:
+      path = os.path.join(self.bundle_dir(uuid), subpath)
+      return key, os.path.abspath(path), uuid
+    if os.path.exists(target):
+      return key, os.path.abspath(target), None
+    raise ValueError('Cannot resolve dependency "%s" locally' % dep)
+
+  def submit(self, cmd, deps, name, description='', cpus=1, omp_num_threads=1):
+    """Queue a job and return its uuid."""
+    if cpus > self.num_cpus:
+      raise ValueError('Job requests %d cpus, only %d available' % (
+          cpus, self.num_cpus))
+    uuid = '0x%s' % uuidlib.uuid4().hex
+    with self.cond:
+      resolved = [self._resolve_dep(d) for d in deps]
+      job = LocalJob(uuid, cmd, [(k, p) for k, p, u in resolved],
+                     name, description, cpus, omp_num_threads)
+      job.dep_uuids = [u for k, p, u in resolved if u]
+      self.jobs[uuid] = job
+      self.name_to_uuid[name] = uuid
+      self.queue.append(job)
+      self._schedule()
+    return uuid
+
+  def _schedule(self):
+    """Start every queued job that is ready and fits on the free cores.
+
+    Jobs are considered in submission order (first fit).  A job is ready
+    once all local jobs it depends on have finished successfully.
+    Must be called with self.cond held.
+    """
+    waiting = []
+    for job in self.queue:
+      dep_states = [self.jobs[u].state for u in job.dep_uuids]
+      if STATE_FAILED in dep_states:
+        job.state = STATE_FAILED
+        log('Local job %s (%s) failed: a dependency failed' % (job.name, job.uuid))
+        self.cond.notify_all()
+      elif any(s != STATE_READY for s in dep_states):
+        waiting.append(job)
+      elif job.cpus <= len(self.free_cores):
+        job.cores = self.free_cores[:job.cpus]
+        self.free_cores = self.free_cores[job.cpus:]
+        try:
+          self._start(job)
+        except Exception as e:
+          # E.g. the bundle directory or a dependency link can't be made
+          job.state = STATE_FAILED
+          job.end_time = time.time()
+          self.free_cores = sorted(self.free_cores + job.cores)
+          log('Local job %s (%s) failed to start: %s' % (job.name, job.uuid, e))
+          self.cond.notify_all()
+      else:
+        waiting.append(job)
+    self.queue = waiting
+
+  def _start(self, job):
+    bundle_dir = self.bundle_dir(job.uuid)
+    os.makedirs(bundle_dir)
+    for key, path in job.deps:
+      os.symlink(path, os.path.join(bundle_dir, key))
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(job.omp_num_threads)
+    call_args = ['bash', '-c', job.cmd]
+    if self.taskset:
+      cores_str = ','.join(str(c) for c in job.cores)
+      call_args = [self.taskset, '-c', cores_str] + call_args
+    stdout = open(os.path.join(bundle_dir, 'stdout'), 'wb')
+    stderr = open(os.path.join(bundle_dir, 'stderr'), 'wb')
+    job.state = STATE_RUNNING
+    job.start_time = time.time()
+    try:
+      p = subprocess.Popen(call_args, cwd=bundle_dir, env=env,
+                           stdout=stdout, stderr=stderr)
+    except Exception:
+      stdout.close()
+      stderr.close()
+      raise
+    log('Started local job %s (%s) on cores %s' % (job.name, job.uuid, job.cores))
+    t = threading.Thread(target=self._watch, args=(job, p, stdout, stderr))
+    t.daemon = True
+    t.start()
+
+  def _watch(self, job, p, stdout, stderr):
+    exitcode = p.wait()
+    stdout.close()
+    stderr.close()
+    bundle_dir = self.bundle_dir(job.uuid)
+    for key, path in job.deps:
+      # Like CodaLab, dependencies are not part of the bundle contents
+      link = os.path.join(bundle_dir, key)
+      if os.path.islink(link):
+        os.remove(link)
+    with self.cond:
+      job.exitcode = exitcode
+      job.end_time = time.time()
+      job.state = STATE_READY if exitcode == 0 else STATE_FAILED
+      with open(bundle_dir + '.json', 'w') as f:
+        json.dump(job.to_dict(), f, indent=2)
+      self.free_cores = sorted(self.free_cores + job.cores)
+      self._schedule()
+      self.cond.notify_all()
+    log('Local job %s (%s) finished: %s' % (job.name, job.uuid, job.state))
+
+  def wait(self, uuids=None):
+    """Block until the given jobs (default = all jobs) have finished."""
+    with self.cond:
+      if uuids is None:
+        uuids = list(self.jobs)
+      while any(self.jobs[u].state in (STATE_QUEUED, STATE_RUNNING)
+                for u in uuids):
+        # Timeout lets KeyboardInterrupt through on Python 2
+        self.cond.wait(1.0)
+    return [self.jobs[u].state for u in uuids]
+
+  def get_state(self, uuid):
+    return self.jobs[uuid].state
@@ -0,0 +1,206 @@
+"""A low-overhead hierarchical profiler.
+
+Sections are named and nest: entering section "b" while inside section "a"
+records time under the path ("a", "b").  Each thread keeps its own stack of
+open sections, while statistics are aggregated across threads.
+
+util.timer() and util.timed() record into the default profiler, PROFILER,
+so instrumentation can be left on and the aggregate report read afterwards:
+
+  with timer('Epoch', quiet=True):
+    ...
+  PROFILER.dump_at_exit('profile.txt', json_file='profile.json')
+"""
+import atexit
+import collections
+from contextlib import contextmanager
+import json
+import random
+import sys
+import threading
+import time
+
+MAX_SAMPLES = 10000  # Samples kept per section for estimating percentiles
+
+class SectionStats(object):
+  """Aggregate statistics for a single profiler section."""
+  def __init__(self, max_samples=MAX_SAMPLES):
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+    self.mem_peak = None
+    self.max_samples = max_samples
+    self.samples = []  # Reservoir sample of durations
+    self._rng = random.Random(0)
+
+  def add(self, elapsed, mem_peak=None):
+    self.count += 1
+    self.total += elapsed
+    if self.min is None or elapsed < self.min:
+      self.min = elapsed
+    if self.max is None or elapsed > self.max:
+      self.max = elapsed
+    if mem_peak is not None and (self.mem_peak is None or mem_peak > self.mem_peak):
+      self.mem_peak = mem_peak
+    if len(self.samples) < self.max_samples:
+      self.samples.append(elapsed)
+    else:
+      i = self._rng.randint(0, self.count - 1)
+      if i < self.max_samples:
+        self.samples[i] = elapsed
+
+  def mean(self):
+    if not self.count: return 0.0
+    return self.total / self.count
+
+  def percentile(self, p):
+    """Estimate the p-th percentile (0 <= p <= 100) of the durations."""
+    if not self.samples: return 0.0
+    sorted_samples = sorted(self.samples)
+    ind = int(round(p / 100.0 * (len(sorted_samples) - 1)))
+    return sorted_samples[ind]
+
+  def to_dict(self):
+    d = collections.OrderedDict()
+    d['count'] = self.count
+    d['total'] = self.total
+    d['mean'] = self.mean()
+    d['min'] = self.min
+    d['max'] = self.max
+    d['p50'] = self.percentile(50)
+    d['p99'] = self.percentile(99)
+    if self.mem_peak is not None:
+      d['mem_peak'] = self.mem_peak
+    return d
+
+class Profiler(object):
+  """A thread-safe registry of nested, named timing sections."""
+  def __init__(self, track_memory=False, max_samples=MAX_SAMPLES):
+    """Create the profiler.
+
+    Args:
+      track_memory: if True, also record peak memory with tracemalloc.
+      max_samples: number of durations kept per section for percentiles.
+    """
+    self.max_samples = max_samples
+    self.stats = collections.OrderedDict()  # path tuple -> SectionStats
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._tracemalloc = None
+    if track_memory:
+      self.enable_memory_tracking()
+
+  def enable_memory_tracking(self):
+    """Start recording the peak traced memory of each section.
+
+    Requires the tracemalloc module (pytracemalloc on Python 2).
+    The recorded peak is relative to the traced memory when the section
+    was entered.  Since tracemalloc only keeps a process-wide high-water
+    mark, a section that never exceeds an earlier peak is credited with
+    its net allocation instead.
+    """
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+      tracemalloc.start()
+    self._tracemalloc = tracemalloc
+
+  def _get_stack(self):
+    try:
+      return self._local.stack
+    except AttributeError:
+      self._local.stack = []
+      return self._local.stack
+
+  def current_path(self):
+    """Return the path of sections currently open in this thread."""
+    return tuple(self._get_stack())
+
+  @contextmanager
+  def section(self, name):
+    """Time the enclosed block as a section nested in the current one."""
+    stack = self._get_stack()
+    stack.append(name)
+    path = tuple(stack)
+    tm = self._tracemalloc
+    if tm:
+      mem_start, peak_start = tm.get_traced_memory()
+    t0 = time.time()
+    try:
+      yield
+    finally:
+      elapsed = time.time() - t0
+      mem_peak = None
+      if tm:
+        mem_end, peak_end = tm.get_traced_memory()
+        mem_peak = mem_end - mem_start
+        if peak_end > peak_start:
+          mem_peak = max(mem_peak, peak_end - mem_start)
+      stack.pop()
+      self.record(path, elapsed, mem_peak=mem_peak)
+
+  def record(self, path, elapsed, mem_peak=None):
+    """Record one call of the section at the given path."""
+    with self._lock:
+      if path not in self.stats:
+        self.stats[path] = SectionStats(max_samples=self.max_samples)
+      self.stats[path].add(elapsed, mem_peak=mem_peak)
+
+  def reset(self):
+    with self._lock:
+      self.stats = collections.OrderedDict()
+
+  def to_dict(self):
+    """Return the aggregated statistics as a nested dict.
+
+    Each section maps to its statistics plus a 'children' dict.
+    """
+    root = collections.OrderedDict()
+    with self._lock:
+      items = [(path, s.to_dict()) for path, s in self.stats.iteritems()]
+    for path, d in sorted(items, key=lambda x: len(x[0])):
+      node = root
+      for name in path[:-1]:
+        if name not in node:
+          node[name] = collections.OrderedDict([('children', collections.OrderedDict())])
+        node = node[name]['children']
+      d['children'] = node[path[-1]]['children'] if path[-1] in node else collections.OrderedDict()
+      node[path[-1]] = d
+    return root
+
+  def to_json(self, indent=2):
+    return json.dumps(self.to_dict(), indent=indent)
+
+  def report(self):
+    """Return a human-readable tree of the aggregated statistics."""
+    lines = ['%-40s %10s %10s %10s %10s %10s %10s' % (
+        'section', 'calls', 'total', 'mean', 'p50', 'p99', 'mem_peak')]
+    def recurse(node, depth):
+      for name, d in node.iteritems():
+        if 'count' in d:
+          mem_str = '%d' % d['mem_peak'] if 'mem_peak' in d else '-'
+          lines.append('%-40s %10d %10.4f %10.6f %10.6f %10.6f %10s' % (
+              ('  ' * depth + str(name))[:40], d['count'], d['total'],
+              d['mean'], d['p50'], d['p99'], mem_str))
+        else:
+          lines.append('%-40s' % ('  ' * depth + str(name))[:40])
+        recurse(d['children'], depth + 1)
+    recurse(self.to_dict(), 0)
+    return '\n'.join(lines)
+
+  def dump(self, filename=None, json_file=None):
+    """Write the report to filename (or stderr), and JSON to json_file."""
+    if filename:
+      with open(filename, 'w') as f:
+        f.write(self.report() + '\n')
+    else:
+      print >> sys.stderr, self.report()
+    if json_file:
+      with open(json_file, 'w') as f:
+        f.write(self.to_json() + '\n')
+
+  def dump_at_exit(self, filename=None, json_file=None):
+    """Arrange for dump() to be called when the interpreter exits."""
+    atexit.register(self.dump, filename=filename, json_file=json_file)
+
+PROFILER = Profiler()
@@ -0,0 +1,224 @@
+"""An inverted index for top-k similarity search over sparse vectors.
+
+Vectors may be dicts (as in vecops), or array-backed sparse vectors,
+i.e. anything with parallel |indices| and |data| arrays (such as a row of
+a scipy.sparse matrix), or a (indices, values) pair.
+"""
+import math
+import numpy as np
+
+DOT = 'dot'
+COSINE = 'cosine'
+
+def sparse_items(v):
+  """Return a list of (feature, value) pairs for a sparse vector.
+
+  Features within a single vector are assumed to be unique.
+  """
+  if isinstance(v, dict):
+    return v.items()
+  if hasattr(v, 'indices') and hasattr(v, 'data'):
+    return zip(np.asarray(v.indices).tolist(), np.asarray(v.data).tolist())
+  if isinstance(v, tuple) and len(v) == 2:
+    indices, values = v
+    return zip(np.asarray(indices).tolist(), np.asarray(values).tolist())
+  raise TypeError('Unrecognized sparse vector type %s' % type(v))
+
+class InvertedIndex(object):
+  """An inverted index mapping features to postings lists.
+
+  Each postings list is a pair of parallel arrays (doc_ids, weights),
+  sorted by doc_id.  Search accumulates scores only for documents that
+  share a feature with the query, then partially sorts the accumulator
+  to extract the top k.
+
+  With prune=True, search uses MaxScore pruning: query terms are sorted by
+  their maximum possible contribution, and the terms with the largest
+  bounds are essential, i.e. their postings lists are scored in full.
+  Once the bounds of the remaining terms sum to less than the k-th best
+  score so far, no unseen document can make it into the top k, so the
+  remaining (non-essential) terms are only scored against the surviving
+  candidates, which are pruned further after each term.  This pays off
+  when low-weight features (e.g. frequent words under tf-idf) have the
+  longest postings lists.
+  """
+  def __init__(self):
+    self.num_docs = 0
+    self.norms = []
+    self._pending = {}  # feature -> (new doc_ids, new weights)
+    self.postings = {}  # feature -> (doc_ids, weights)
+    self.max_weights = {}  # feature -> (max weight, min weight)
+    self.max_cos_weights = {}  # feature -> (max weight / norm, min weight / norm)
+    self._norm_array = None
+
+  def add(self, v):
+    """Add a sparse vector to the index and return its doc id."""
+    doc_id = self.num_docs
+    norm_sq = 0.0
+    for k, x in sparse_items(v):
+      if x == 0: continue
+      doc_ids, weights = self._pending.setdefault(k, ([], []))
+      doc_ids.append(doc_id)
+      weights.append(x)
+      norm_sq += x * x
+    self.norms.append(math.sqrt(norm_sq))
+    self.num_docs += 1
+    return doc_id
+
+  def add_all(self, vecs):
+    """Add many sparse vectors, return the list of their doc ids."""
+    return [self.add(v) for v in vecs]
+
+  def _finalize(self):
+    """Merge pending additions into the array-backed postings lists."""
+    if not self._pending and self._norm_array is not None:
+      return
+    norms = np.array(self.norms, dtype=np.float64)
+    norms[norms == 0] = 1.0
+    self._norm_array = norms
+    for k, (new_ids, new_weights) in self._pending.iteritems():
+      new_ids = np.array(new_ids, dtype=np.int64)
+      new_weights = np.array(new_weights, dtype=np.float64)
+      if k in self.postings:
+        old_ids, old_weights = self.postings[k]
+        new_ids = np.concatenate([old_ids, new_ids])
+        new_weights = np.concatenate([old_weights, new_weights])
+      self.postings[k] = (new_ids, new_weights)
+      self.max_weights[k] = (new_weights.max(), new_weights.min())
+    # Only the bounds of features with new postings can change
+    for k in self._pending:
+      doc_ids, weights = self.postings[k]
+      scaled = weights / norms[doc_ids]
+      self.max_cos_weights[k] = (scaled.max(), scaled.min())
+    self._pending = {}
+
+  def _query_terms(self, query, metric):
+    """Get (feature, query weight, upper bound, lower bound) for each query term."""
+    if metric == DOT:
+      bounds = self.max_weights
+    elif metric == COSINE:
+      bounds = self.max_cos_weights
+    else:
+      raise ValueError('Unrecognized metric "%s"' % metric)
+    items = [(k, x) for k, x in sparse_items(query) if x != 0]
+    if metric == COSINE:
+      q_norm = math.sqrt(sum(x * x for k, x in items))
+      if q_norm > 0:
+        items = [(k, x / q_norm) for k, x in items]
+    terms = []
+    for k, x in items:
+      if k not in self.postings: continue
+      w_max, w_min = bounds[k]
+      upper = max(x * w_max, x * w_min, 0.0)
+      lower = min(x * w_max, x * w_min, 0.0)
+      terms.append((k, x, upper, lower))
+    return terms
+
+  def _search(self, query, k, metric, prune, scores, touched):
+    terms = self._query_terms(query, metric)
+    if prune:
+      terms.sort(key=lambda t: t[2], reverse=True)
+    # Bounds on what terms[i:] can add to a score
+    rem_upper = np.zeros(len(terms) + 1)
+    rem_lower = np.zeros(len(terms) + 1)
+    if terms:
+      rem_upper[:-1] = np.cumsum([t[2] for t in terms[::-1]])[::-1]
+      rem_lower[:-1] = np.cumsum([t[3] for t in terms[::-1]])[::-1]
+    seen = []  # Arrays of doc ids, each seen for the first time by one term
+    max_score = -np.inf  # Upper bound on the best score so far
+    candidates = None  # Sorted doc ids still eligible, once pruning kicks in
+    threshold = None  # Lower bound on the final k-th best score
+    for i, (feat, x, upper, lower) in enumerate(terms):
+      doc_ids, weights = self.postings[feat]
+      if candidates is None:
+        # Essential term: score every doc in its postings list
+        if metric == COSINE:
+          contrib = weights / self._norm_array[doc_ids]
+        else:
+          contrib = weights
+        new_ids = doc_ids[~touched[doc_ids]]
+        touched[new_ids] = True
+        seen.append(new_ids)
+        scores[doc_ids] += x * contrib
+        if not prune or i + 1 == len(terms): continue
+        max_score = max(max_score, scores[doc_ids].max())
+        if max_score + rem_lower[i + 1] <= rem_upper[i + 1]: continue
+        # The remaining terms are non-essential if at least k docs are
+        # sure to beat any unseen doc
+        seen = [np.concatenate(seen)]
+        lower_scores = scores[seen[0]] + rem_lower[i + 1]
+        above = lower_scores[lower_scores > rem_upper[i + 1]]
+        if len(above) < k: continue
+        threshold = np.partition(above, len(above) - k)[len(above) - k]
+        candidates = seen[0][scores[seen[0]] + rem_upper[i + 1] >= threshold]
+        candidates.sort()
+      else:
+        # Non-essential term: only score surviving candidates
+        if len(candidates) <= len(doc_ids):
+          pos = np.searchsorted(doc_ids, candidates)
+          pos[pos == len(doc_ids)] = 0
+          pos = pos[doc_ids[pos] == candidates]
+        else:
+          pos = np.searchsorted(candidates, doc_ids)
+          pos[pos == len(candidates)] = 0
+          pos = np.flatnonzero(candidates[pos] == doc_ids)
+        hit_ids = doc_ids[pos]
+        contrib = weights[pos]
+        if metric == COSINE:
+          contrib = contrib / self._norm_array[hit_ids]
+        scores[hit_ids] += x * contrib
+        if i + 1 < len(terms):
+          cand_scores = scores[candidates]
+          if len(candidates) > k:
+            lower_scores = cand_scores + rem_lower[i + 1]
+            threshold = max(threshold, np.partition(
+                lower_scores, len(candidates) - k)[len(candidates) - k])
+          candidates = candidates[cand_scores + rem_upper[i + 1] >= threshold]
+    if candidates is None:
+      if seen:
+        candidates = np.concatenate(seen)
+      else:
+        candidates = np.zeros(0, dtype=np.int64)
+    cand_scores = scores[candidates]
+    if len(candidates) > k:
+      # Keep every doc tied with the k-th best, so ties go to lower doc ids
+      kth = -np.partition(-cand_scores, k - 1)[k - 1]
+      top = np.flatnonzero(cand_scores >= kth)
+    else:
+      top = np.arange(len(candidates))
+    order = top[np.lexsort((candidates[top], -cand_scores[top]))][:k]
+    results = [(int(candidates[i]), float(cand_scores[i])) for i in order]
+    # Reset only the entries we touched, so buffers can be reused
+    for doc_ids in seen:
+      scores[doc_ids] = 0.0
+      touched[doc_ids] = False
+    return results
+
+  def search(self, query, k=10, metric=DOT, prune=False):
+    """Find the k indexed vectors most similar to the query.
+
+    Args:
+      query: A sparse vector.
+      k: Number of results to return.
+      metric: Either 'dot' or 'cosine'.
+      prune: If True, use MaxScore pruning (same results; faster when
+          frequent features have small weights, as with tf-idf).
+    Returns:
+      A list of (doc_id, score) pairs in decreasing order of score, ties
+      broken by increasing doc_id.  Only vectors sharing at least one
+      feature with the query are returned.
+    """
+    return self.search_batch([query], k=k, metric=metric, prune=prune)[0]
+
+  def search_batch(self, queries, k=10, metric=DOT, prune=False):
+    """Run search() on many queries, sharing accumulator buffers."""
+    self._finalize()
+    if k <= 0:
+      return [[] for q in queries]
+    scores = np.zeros(self.num_docs, dtype=np.float64)
+    touched = np.zeros(self.num_docs, dtype=np.bool_)
+    return [self._search(q, k, metric, prune, scores, touched)
+            for q in queries]
+
+  def __len__(self):
+    return self.num_docs
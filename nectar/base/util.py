@@ -1,13 +1,96 @@
 """General, miscellaneous utilities."""
 from contextlib import contextmanager
+import collections
+import itertools
+import multiprocessing
+import os
 import sys
+import threading
 import time
+import traceback
+
+from profiler import PROFILER
 
 def flatten(x):
   """Flatten a list of lists."""
   return [a for b in x for a in b]
 
+LOG_FLUSH_INTERVAL = 0.1  # Seconds between writes of the background log writer
+
+def _encode_for(msg, stream):
+  """Convert a log message to a byte string, as print would for stream.
+
+  Messages are converted one at a time, so that joining them never mixes
+  non-ASCII byte strings with unicode.
+  """
+  if isinstance(msg, unicode):
+    return msg.encode(getattr(stream, 'encoding', None) or 'utf-8', 'replace')
+  return str(msg)
+
+class LogWriter(object):
+  """Batches log messages and writes them from a background thread.
+
+  Consecutive disappearing messages are coalesced, so only the latest one
+  is written at each flush.
+
+  The writer belongs to the process that created it: a forked child
+  (e.g. a multiprocessing worker) inherits it without its thread, and
+  possibly with its lock held, so log() bypasses it there.
+  """
+  def __init__(self, flush_interval=LOG_FLUSH_INTERVAL):
+    self.flush_interval = flush_interval
+    self.pid = os.getpid()
+    self._lock = threading.Lock()
+    self._buffer = []  # list of (msg, disappearing)
+    self._stopped = threading.Event()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def write(self, msg, disappearing=False):
+    with self._lock:
+      if self._buffer and self._buffer[-1][1]:
+        # Overwrite a pending disappearing message
+        self._buffer[-1] = (msg, disappearing)
+      else:
+        self._buffer.append((msg, disappearing))
+
+  def flush(self):
+    with self._lock:
+      buf = self._buffer
+      self._buffer = []
+    if not buf: return
+    if not sys.stdout.isatty():
+      # Only print to stdout if it's being redirected or piped
+      sys.stdout.write(''.join(
+          '%s\n' % _encode_for(msg, sys.stdout) for msg, d in buf))
+      sys.stdout.flush()
+    sys.stderr.write(''.join(
+        '%s%s' % (_encode_for(msg, sys.stderr), '\r' if d else '\n')
+        for msg, d in buf))
+    sys.stderr.flush()
+
+  def _run(self):
+    while not self._stopped.wait(self.flush_interval):
+      try:
+        self.flush()
+      except Exception:
+        # Keep the thread alive, or every later message would be lost
+        traceback.print_exc()
+
+  def close(self):
+    """Stop the background thread and write everything still buffered."""
+    self._stopped.set()
+    self._thread.join()
+    self.flush()
+
+_LOG_WRITER = None
+
 def log(msg, disappearing=False):
+  writer = _LOG_WRITER
+  if writer and writer.pid == os.getpid():
+    writer.write(msg, disappearing=disappearing)
+    return
   if not sys.stdout.isatty():
     # Only print to stdout if it's being redirected or piped
     print msg
@@ -17,6 +100,27 @@ def log(msg, disappearing=False):
   else:
     print >> sys.stderr, msg
 
+@contextmanager
+def buffered_log(flush_interval=LOG_FLUSH_INTERVAL):
+  """Route log() through a background LogWriter inside this block.
+
+  Everything logged is written out by the time the block exits.
+  Nested uses share the outermost writer.  Processes forked inside the
+  block log directly, unbuffered.
+  """
+  global _LOG_WRITER
+  if _LOG_WRITER and _LOG_WRITER.pid == os.getpid():
+    yield
+    return
+  inherited = _LOG_WRITER  # From a parent process, if forked
+  _LOG_WRITER = LogWriter(flush_interval=flush_interval)
+  try:
+    yield
+  finally:
+    writer = _LOG_WRITER
+    _LOG_WRITER = inherited
+    writer.close()
+
 def log_dict(d, name):
   log('%s {' % name)
   for k in d:
@@ -45,22 +149,236 @@ def secs_to_str(secs):
     return '%.1fs' % secs
   return '%.2fs' % secs
 
-def timed(func, msg, allow_overwrite=True):
-  msg1 = '%s...' % msg
-  log(msg1, disappearing=allow_overwrite)
-  t0 = time.time()
-  retval = func()
-  t1 = time.time()
-  msg2 = '%s [took %s].' % (msg, secs_to_str(t1 - t0))
-  log(msg2)
-  return retval
+def timed(func, msg, allow_overwrite=True, quiet=False):
+  """Call func(), logging how long it took.
+
+  The call is also recorded as a section of the default profiler.
+
+  Args:
+    func: function of no arguments to call.
+    msg: message to log; also the name of the profiler section.
+    allow_overwrite: if True, the starting message is overwritten.
+    quiet: if True, only record in the profiler, don't log anything.
+        Use this inside hot loops.
+  """
+  with timer(msg, allow_overwrite=allow_overwrite, quiet=quiet):
+    return func()
+
+class Progress(object):
+  """Tracks throughput of a loop and logs a status line at a fixed rate.
+
+  Example:
+    p = Progress(total=len(data), msg='Annotating')
+    for x in data:
+      ...
+      p.update()
+    p.finish()
+  """
+  def __init__(self, total=None, msg='Progress', unit='items',
+               refresh_interval=0.5):
+    """Create the meter.
+
+    Args:
+      total: total number of items, if known (needed for the ETA).
+      msg: prefix of the status line.
+      unit: name of the items being counted.
+      refresh_interval: minimum number of seconds between redraws.
+    """
+    self.total = total
+    self.msg = msg
+    self.unit = unit
+    self.refresh_interval = refresh_interval
+    self.count = 0
+    self.start_time = time.time()
+    self._last_draw = self.start_time
+
+  def update(self, n=1):
+    """Record that n more items are done, redrawing if enough time passed."""
+    self.count += n
+    now = time.time()
+    if now - self._last_draw >= self.refresh_interval:
+      self._last_draw = now
+      log(self.format(now), disappearing=True)
+
+  def elapsed(self, now=None):
+    return (now or time.time()) - self.start_time
+
+  def rate(self, now=None):
+    """Items processed per second so far."""
+    elapsed = self.elapsed(now)
+    if elapsed <= 0: return 0.0
+    return self.count / elapsed
+
+  def eta(self, now=None):
+    """Estimated seconds remaining, or None if unknown."""
+    rate = self.rate(now)
+    if self.total is None or rate <= 0: return None
+    return max(self.total - self.count, 0) / rate
+
+  def format(self, now=None):
+    if self.total:
+      count_str = '%d/%d %s (%.1f%%)' % (
+          self.count, self.total, self.unit, 100.0 * self.count / self.total)
+    else:
+      count_str = '%d %s' % (self.count, self.unit)
+    rate_str = '%.1f %s/s' % (self.rate(now), self.unit)
+    eta = self.eta(now)
+    if eta is None:
+      time_str = 'elapsed %s' % secs_to_str(self.elapsed(now))
+    else:
+      time_str = 'ETA %s' % secs_to_str(eta)
+    return '%s: %s [%s, %s]' % (self.msg, count_str, rate_str, time_str)
+
+  def finish(self):
+    """Log the final status line."""
+    now = time.time()
+    log('%s: %d %s [%.1f %s/s, took %s].' % (
+        self.msg, self.count, self.unit, self.rate(now), self.unit,
+        secs_to_str(self.elapsed(now))))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.finish()
+
+def progress(iterable, total=None, msg='Progress', unit='items',
+             refresh_interval=0.5):
+  """Iterate over iterable while logging throughput with a Progress."""
+  if total is None and hasattr(iterable, '__len__'):
+    total = len(iterable)
+  p = Progress(total=total, msg=msg, unit=unit,
+               refresh_interval=refresh_interval)
+  for x in iterable:
+    yield x
+    p.update()
+  p.finish()
 
 @contextmanager
-def timer(msg, allow_overwrite=True):
-  msg1 = '%s...' % msg
-  log(msg1, disappearing=allow_overwrite)
+def timer(msg, allow_overwrite=True, quiet=False):
+  """Time the enclosed block; arguments are as in timed()."""
+  if not quiet:
+    msg1 = '%s...' % msg
+    log(msg1, disappearing=allow_overwrite)
   t0 = time.time()
-  yield
-  t1 = time.time()
-  msg2 = '%s [took %s].' % (msg, secs_to_str(t1 - t0))
-  log(msg2)
+  with PROFILER.section(msg):
+    yield
+  if not quiet:
+    t1 = time.time()
+    msg2 = '%s [took %s].' % (msg, secs_to_str(t1 - t0))
+    log(msg2)
+
+MIN_PARALLEL_ITEMS = 64  # Inputs smaller than this are mapped serially
+STREAM_CHUNKSIZE = 32  # Default chunk size when the input length is unknown
+
+class WorkerError(Exception):
+  """An exception raised in a parallel_map worker.
+
+  The message includes the worker's formatted traceback.
+  """
+  pass
+
+def _map_chunk(func_chunk):
+  func, chunk = func_chunk
+  try:
+    return True, [func(x) for x in chunk]
+  except Exception:
+    return False, traceback.format_exc()
+
+def _serial_imap(func, items):
+  """itertools.imap(), raising WorkerError like the parallel path."""
+  for x in items:
+    try:
+      y = func(x)
+    except Exception:
+      raise WorkerError('Exception in parallel_map worker:\n%s' %
+                        traceback.format_exc())
+    yield y
+
+def _iter_chunks(iterable, chunksize):
+  it = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(it, chunksize))
+    if not chunk: return
+    yield chunk
+
+def _parallel_imap(func, items, num_procs, chunksize, max_in_flight):
+  pool = multiprocessing.Pool(num_procs)
+  try:
+    in_flight = collections.deque()
+    for chunk in _iter_chunks(items, chunksize):
+      in_flight.append(pool.apply_async(_map_chunk, ((func, chunk),)))
+      while len(in_flight) >= max_in_flight:
+        for y in _get_chunk_result(in_flight.popleft()):
+          yield y
+    while in_flight:
+      for y in _get_chunk_result(in_flight.popleft()):
+        yield y
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+def _get_chunk_result(async_result):
+  success, value = async_result.get()
+  if not success:
+    raise WorkerError('Exception in parallel_map worker:\n%s' % value)
+  return value
+
+def parallel_imap(func, items, num_procs=None, chunksize=None,
+                  max_in_flight=None, min_parallel=MIN_PARALLEL_ITEMS):
+  """Lazily map func over an iterable using a process pool.
+
+  Results are yielded in input order.  At most max_in_flight chunks are
+  submitted but not yet consumed at any time, so arbitrarily long streams
+  can be processed with bounded memory.
+
+  Args:
+    func: a picklable (i.e. module-level) function of one argument.
+    items: an iterable of picklable inputs.
+    num_procs: number of worker processes (default = number of CPUs).
+    chunksize: number of items sent to a worker at once.  If None, chosen
+        from len(items) when available, else STREAM_CHUNKSIZE.
+    max_in_flight: maximum number of outstanding chunks (default = 2 * num_procs).
+    min_parallel: inputs with fewer items than this are mapped serially.
+  Raises:
+    WorkerError: if func raises an exception, whether in a worker or in
+        this process (when mapping serially).
+  """
+  if not num_procs:
+    num_procs = multiprocessing.cpu_count()
+  if hasattr(items, '__len__'):
+    n = len(items)
+    if chunksize is None:
+      # Aim for about 4 chunks per worker, for load balancing
+      chunksize = max(1, -(-n // (4 * num_procs)))
+  else:
+    # Peek ahead to decide whether the input is tiny
+    it = iter(items)
+    head = list(itertools.islice(it, min_parallel))
+    n = len(head)
+    if n == min_parallel:
+      n = None
+    items = itertools.chain(head, it)
+  if num_procs == 1 or (n is not None and n < min_parallel):
+    return _serial_imap(func, items)
+  if chunksize is None:
+    chunksize = STREAM_CHUNKSIZE
+  if max_in_flight is None:
+    max_in_flight = 2 * num_procs
+  return _parallel_imap(func, items, num_procs, chunksize, max_in_flight)
+
+def parallel_map(func, items, num_procs=None, chunksize=None,
+                 max_in_flight=None, min_parallel=MIN_PARALLEL_ITEMS, msg=None):
+  """Map func over items using a process pool; return a list in input order.
+
+  Arguments are as in parallel_imap().  If msg is provided, the whole
+  map is wrapped in timer(msg).
+  """
+  def run():
+    return list(parallel_imap(func, items, num_procs=num_procs,
+                              chunksize=chunksize, max_in_flight=max_in_flight,
+                              min_parallel=min_parallel))
+  if msg:
+    return timed(run, msg)
+  return run()
@@ -1,5 +1,6 @@
 """Operations on sparse vectors represented as dicts."""
 import collections
+import math
 
 # Mutating a vector
 def add(v, other, scale=1):
@@ -32,4 +33,10 @@ def sum(v1, v2):
   return ans
 
 def l2norm(v):
-  return math.sqrt(sum(v[k]**2 for k in v))
+  return math.sqrt(dot(v, v))
+
+def cosine(v1, v2):
+  denom = l2norm(v1) * l2norm(v2)
+  if denom == 0:
+    return 0.0
+  return dot(v1, v2) / denom
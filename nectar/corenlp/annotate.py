@@ -0,0 +1,191 @@
+"""Annotate a large corpus with CoreNLP, streaming and resumably.
+
+Reads one document per line (plain text, or JSON objects with a text
+field), and writes one JSON object per line with the CoreNLP response
+added.  Output line i always corresponds to input line i, so the output
+file doubles as the checkpoint: when rerun on an existing output file,
+annotation resumes after its last complete line.
+
+Example:
+  python -m nectar.corenlp.annotate corpus.txt corpus.corenlp.jsonl \\
+      --annotators tokenize,ssplit,pos,ner --start-server --num-servers 4
+"""
+import argparse
+import collections
+import itertools
+import json
+import os
+import sys
+
+from .. import log
+from ..base.util import Progress
+from client import CoreNLPClient
+from document import AnnotatedDocument
+
+OPTS = None
+
+FORMAT_LINES = 'lines'
+FORMAT_JSONL = 'jsonl'
+
+def count_complete_lines(filename):
+  """Count the complete lines of a file, and truncate any partial last line.
+
+  A partial line is left behind if a previous run was killed mid-write.
+
+  Returns:
+    The number of complete lines, or 0 if the file doesn't exist.
+  """
+  if not os.path.exists(filename):
+    return 0
+  num_lines = 0
+  end = 0  # Byte offset just past the last newline
+  with open(filename, 'rb') as f:
+    for line in f:
+      if not line.endswith('\n'): break
+      num_lines += 1
+      end += len(line)
+  if end < os.path.getsize(filename):
+    log('Truncating partial last line of %s' % filename)
+    with open(filename, 'r+b') as f:
+      f.truncate(end)
+  return num_lines
+
+def read_docs(in_file, input_format=FORMAT_LINES, text_field='text'):
+  """Lazily read (record, text) pairs, one per line of in_file.
+
+  in_file should hold UTF-8; texts are returned as unicode.
+  """
+  for line in in_file:
+    line = line.decode('utf-8').rstrip('\n')
+    if input_format == FORMAT_JSONL:
+      record = json.loads(line)
+      yield record, record[text_field]
+    else:
+      yield {text_field: line}, line
+
+def annotate_stream(client, docs, properties, max_concurrency=None):
+  """Annotate (record, text) pairs, yielding (record, response) in order.
+
+  Requests are sent concurrently by client.query_iter(), which reads
+  only a bounded number of documents ahead of the output.
+  """
+  pending = collections.deque()  # Records whose texts have been read
+  def texts():
+    for record, text in docs:
+      pending.append(record)
+      yield text
+  for response in client.query_iter(texts(), properties,
+                                    max_concurrency=max_concurrency):
+    if isinstance(response, AnnotatedDocument):
+      response = response.to_json()
+    yield pending.popleft(), response
+
+def annotate_file(client, in_filename, out_filename, properties,
+                  input_format=FORMAT_LINES, text_field='text',
+                  output_field='corenlp', max_concurrency=None,
+                  sync_every=1000):
+  """Annotate every line of in_filename, appending results to out_filename.
+
+  Lines already present in out_filename are skipped, so an interrupted
+  call can simply be repeated.
+
+  Args:
+    client: a CoreNLPClient.
+    in_filename: input file, one document per line.
+    out_filename: output JSONL file.
+    properties: CoreNLP properties of each request.
+    input_format: FORMAT_LINES (raw text) or FORMAT_JSONL.
+    text_field: with FORMAT_JSONL, the field holding the text;
+        with FORMAT_LINES, the field to copy the text into.
+    output_field: field of each output record holding the response.
+    max_concurrency: maximum number of concurrent requests.
+    sync_every: fsync the output every this many documents.
+  Returns:
+    The number of documents annotated by this call.
+  """
+  num_done = count_complete_lines(out_filename)
+  if num_done:
+    log('Resuming after %d documents already in %s' % (num_done, out_filename))
+  with open(in_filename) as in_file, open(out_filename, 'ab') as out_file:
+    docs = itertools.islice(read_docs(in_file, input_format, text_field),
+                            num_done, None)
+    progress = Progress(msg='Annotating', unit='docs')
+    num_chars = 0
+    try:
+      for record, response in annotate_stream(client, docs, properties,
+                                              max_concurrency):
+        record[output_field] = response
+        # One write per line, so a kill leaves at most one partial line
+        out_file.write(json.dumps(record) + '\n')
+        out_file.flush()
+        num_chars += len(record.get(text_field, ''))
+        progress.update()
+        if progress.count % sync_every == 0:
+          os.fsync(out_file.fileno())
+    finally:
+      out_file.flush()
+      os.fsync(out_file.fileno())
+      progress.finish()
+      rate = num_chars / progress.elapsed() if progress.elapsed() > 0 else 0.0
+      log('Annotated %d documents (%.0f chars/s), %d in total' % (
+          progress.count, rate, num_done + progress.count))
+  return progress.count
+
+def parse_properties(annotators, props):
+  """Build CoreNLP properties from --annotators and --property flags."""
+  properties = {
+      'annotators': annotators,
+      'ssplit.newlineIsSentenceBreak': 'always',
+      'outputFormat': 'json',
+  }
+  for p in props:
+    if '=' not in p:
+      raise ValueError('Property "%s" should be key=value' % p)
+    k, v = p.split('=', 1)
+    properties[k] = v
+  return properties
+
+def parse_args(args):
+  parser = argparse.ArgumentParser(
+      description='Annotate a corpus with CoreNLP, resuming if interrupted.')
+  parser.add_argument('in_file', help='Input file, one document per line.')
+  parser.add_argument('out_file', help='Output JSONL file (appended to).')
+  parser.add_argument('--input-format', '-f', choices=[FORMAT_LINES, FORMAT_JSONL],
+                      default=FORMAT_LINES)
+  parser.add_argument('--text-field', default='text',
+                      help='JSON field holding the text of each document.')
+  parser.add_argument('--output-field', default='corenlp',
+                      help='JSON field to store each CoreNLP response in.')
+  parser.add_argument('--annotators', '-a', default='tokenize,ssplit,pos')
+  parser.add_argument('--property', '-p', action='append', default=[],
+                      help='Extra CoreNLP property, as key=value.')
+  parser.add_argument('--hostname', default='http://localhost')
+  parser.add_argument('--port', type=int, default=7000)
+  parser.add_argument('--start-server', action='store_true',
+                      help='Start CoreNLP server(s) if none are running.')
+  parser.add_argument('--num-servers', type=int, default=1)
+  parser.add_argument('--server-log', help='Log file (prefix) of the servers.')
+  parser.add_argument('--cache-file', help='Cache responses in this file.')
+  parser.add_argument('--max-concurrency', '-c', type=int, default=8,
+                      help='Maximum number of concurrent requests.')
+  parser.add_argument('--timeout', type=float,
+                      help='Timeout in seconds of each request.')
+  return parser.parse_args(args)
+
+def main():
+  properties = parse_properties(OPTS.annotators, OPTS.property)
+  client = CoreNLPClient(
+      hostname=OPTS.hostname, port=OPTS.port, start_server=OPTS.start_server,
+      server_log=OPTS.server_log, cache_file=OPTS.cache_file,
+      max_concurrency=OPTS.max_concurrency, timeout=OPTS.timeout,
+      num_servers=OPTS.num_servers,
+      server_warmup_annotators=OPTS.annotators if OPTS.start_server else None)
+  with client:
+    annotate_file(client, OPTS.in_file, OPTS.out_file, properties,
+                  input_format=OPTS.input_format, text_field=OPTS.text_field,
+                  output_field=OPTS.output_field,
+                  max_concurrency=OPTS.max_concurrency)
+
+if __name__ == '__main__':
+  OPTS = parse_args(sys.argv[1:])
+  main()
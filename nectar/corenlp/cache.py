@@ -0,0 +1,174 @@
+"""Caches of CoreNLP responses, used by CoreNLPClient.
+
+Both caches map a string key to a JSON-serializable response and
+support get(), put(), save() and close().
+"""
+import collections
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+DEFAULT_LRU_SIZE = 10000
+
+class JsonCache(object):
+  """A cache held in memory and saved to a single JSON file.
+
+  The whole file is read on construction and rewritten by save().
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.dirty = False
+    if os.path.exists(filename):
+      with open(filename) as f:
+        self.cache = json.load(f)
+    else:
+      self.cache = {}
+
+  def get(self, key):
+    return self.cache.get(key)
+
+  def put(self, key, value):
+    self.cache[key] = value
+    self.dirty = True
+
+  def save(self):
+    if self.dirty:
+      with open(self.filename, 'w') as f:
+        json.dump(self.cache, f)
+    self.dirty = False
+
+  def close(self):
+    self.save()
+
+  def __contains__(self, key):
+    return key in self.cache
+
+  def __len__(self):
+    return len(self.cache)
+
+class SqliteCache(object):
+  """A persistent cache in a sqlite3 database, with an in-memory LRU tier.
+
+  Each put() is written to disk immediately as zlib-compressed JSON, so
+  nothing is lost if the process dies, and opening a large cache is
+  instant.  The database runs in WAL mode, so several processes can
+  share one cache file.
+  """
+  def __init__(self, filename, lru_size=DEFAULT_LRU_SIZE, compress_level=6,
+               timeout=60.0):
+    """Open (or create) the cache.
+
+    Args:
+      filename: path to the sqlite database.
+      lru_size: number of entries to keep in memory (0 to disable).
+      compress_level: zlib compression level for stored values.
+      timeout: seconds to wait for another process's lock.
+    """
+    self.filename = filename
+    self.lru_size = lru_size
+    self.compress_level = compress_level
+    self.timeout = timeout
+    self.lru = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.local = threading.local()  # sqlite connections are per-thread
+    self._inherited_conns = []  # Opened by a parent process before a fork
+    conn = self._get_conn()
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS cache '
+                 '(key TEXT PRIMARY KEY, value BLOB)')
+    conn.commit()
+
+  def _get_conn(self):
+    conn = getattr(self.local, 'conn', None)
+    if conn is not None and self.local.pid != os.getpid():
+      # sqlite connections must not be used across a fork.  Keep the
+      # parent's connection referenced, so it isn't closed here either.
+      self._inherited_conns.append(conn)
+      conn = None
+    if conn is None:
+      conn = sqlite3.connect(self.filename, timeout=self.timeout)
+      conn.execute('PRAGMA synchronous=NORMAL')
+      self.local.conn = conn
+      self.local.pid = os.getpid()
+    return conn
+
+  def _db_key(self, key):
+    if isinstance(key, str):
+      # sqlite3 rejects non-ASCII byte strings
+      return key.decode('utf-8')
+    return key
+
+  def _lru_put(self, key, value):
+    if not self.lru_size: return
+    with self.lock:
+      self.lru.pop(key, None)
+      self.lru[key] = value
+      if len(self.lru) > self.lru_size:
+        self.lru.popitem(last=False)
+
+  def get(self, key):
+    with self.lock:
+      if key in self.lru:
+        value = self.lru.pop(key)
+        self.lru[key] = value  # Move to most recently used
+        return value
+    row = self._get_conn().execute(
+        'SELECT value FROM cache WHERE key = ?', (self._db_key(key),)).fetchone()
+    if row is None:
+      return None
+    value = json.loads(zlib.decompress(bytes(row[0])))
+    self._lru_put(key, value)
+    return value
+
+  def put(self, key, value):
+    blob = zlib.compress(json.dumps(value), self.compress_level)
+    conn = self._get_conn()
+    conn.execute('INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)',
+                 (self._db_key(key), sqlite3.Binary(blob)))
+    conn.commit()
+    self._lru_put(key, value)
+
+  def save(self):
+    """Nothing to do, every put() is already on disk."""
+    pass
+
+  def close(self):
+    conn = getattr(self.local, 'conn', None)
+    if conn is not None:
+      if self.local.pid == os.getpid():
+        conn.close()
+      self.local.conn = None
+
+  def __contains__(self, key):
+    with self.lock:
+      if key in self.lru: return True
+    row = self._get_conn().execute(
+        'SELECT 1 FROM cache WHERE key = ?', (self._db_key(key),)).fetchone()
+    return row is not None
+
+  def __len__(self):
+    return self._get_conn().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+def open_cache(filename, backend=None, **kwargs):
+  """Open a cache file.
+
+  Args:
+    filename: path to the cache.
+    backend: 'json' or 'sqlite'.  If None, use sqlite for filenames ending
+        in one of SQLITE_EXTENSIONS and json otherwise.
+    **kwargs: passed to the cache's constructor.
+  """
+  if backend is None:
+    if filename.endswith(SQLITE_EXTENSIONS):
+      backend = 'sqlite'
+    else:
+      backend = 'json'
+  if backend == 'sqlite':
+    return SqliteCache(filename, **kwargs)
+  elif backend == 'json':
+    return JsonCache(filename, **kwargs)
+  raise ValueError('Unrecognized cache backend "%s"' % backend)
@@ -1,15 +1,105 @@
 """A client for a CoreNLP Server."""
+import collections
 import json
-import os
+from multiprocessing.pool import ThreadPool
 import requests
+import threading
+import time
+import urlparse
 
+from cache import open_cache
+from document import AnnotatedDocument, is_compact
+from pool import CoreNLPServerPool, LoadBalancer
 from server import CoreNLPServer
 
+RETRY_STATUS_CODES = (502, 503, 504)
+DEFAULT_BATCH_CHARS = 20000  # Target request size for query_batched()
+COMPACT_KEY_SUFFIX = '\tcompact'  # Cache keys of compact entries
+# Annotators whose output is not per sentence, which query_batched() can't split
+DOCUMENT_ANNOTATORS = frozenset(['coref', 'dcoref', 'quote'])
+
+def properties_key(properties):
+  """A canonical string for a properties dict, for use in cache keys."""
+  return json.dumps(properties, sort_keys=True)
+
+def _annotator_set(properties):
+  return set(a.strip() for a in properties.get('annotators', '').split(',')
+             if a.strip())
+
+def _subsumption_key(data, properties):
+  """Cache key listing the annotator sets cached for data and properties.
+
+  All properties other than the annotators are part of the key, so
+  responses are only shared across identical tokenize/ssplit/etc. settings.
+  """
+  settings = dict((k, v) for k, v in properties.iteritems() if k != 'annotators')
+  return '\0annotators\t%s\t%s' % (data, properties_key(settings))
+
+def _utf16_len(text):
+  """Length of text in UTF-16 code units, which CoreNLP offsets count."""
+  if isinstance(text, str):
+    text = text.decode('utf-8')
+  return len(text.encode('utf-16-le')) // 2
+
+def _split_response(response, texts):
+  """Split the response to '\\n'.join(texts) into one response per text.
+
+  Sentences are assigned to texts by character offset, and offsets are
+  made relative to the start of each text.  Only sentence-level
+  annotations are kept.
+  """
+  starts = []
+  ends = []
+  cur = 0
+  for t in texts:
+    starts.append(cur)
+    cur += _utf16_len(t)
+    ends.append(cur)
+    cur += 1  # The joining newline
+  responses = [{'sentences': []} for t in texts]
+  i = 0
+  num_tokens = 0  # Tokens in all sentences so far
+  token_start = 0  # Tokens in all sentences of texts before text i
+  for sent in response['sentences']:
+    begin = sent['tokens'][0]['characterOffsetBegin']
+    while i + 1 < len(texts) and begin >= starts[i + 1]:
+      i += 1
+      token_start = num_tokens
+    num_tokens += len(sent['tokens'])
+    start = starts[i]
+    sent['index'] = len(responses[i]['sentences'])
+    for tok in sent['tokens']:
+      tok['characterOffsetBegin'] -= start
+      tok['characterOffsetEnd'] -= start
+    first = sent['tokens'][0]
+    if not responses[i]['sentences'] and 'before' in first:
+      # Drop the part of the whitespace that came from the previous text
+      keep = first['characterOffsetBegin']
+      first['before'] = first['before'][len(first['before']) - keep:] if keep else ''
+    for m in sent.get('entitymentions', []):
+      m['characterOffsetBegin'] -= start
+      m['characterOffsetEnd'] -= start
+      if 'docTokenBegin' in m:
+        m['docTokenBegin'] -= token_start
+        m['docTokenEnd'] -= token_start
+    responses[i]['sentences'].append(sent)
+  for i, r in enumerate(responses):
+    if r['sentences']:
+      last = r['sentences'][-1]['tokens'][-1]
+      if 'after' in last:
+        keep = ends[i] - starts[i] - last['characterOffsetEnd']
+        last['after'] = last['after'][:keep]
+  return responses
+
 class CoreNLPClient(object):
   """A client that interacts with the CoreNLPServer."""
   def __init__(self, hostname='http://localhost', port=7000,
                start_server=False, server_flags=None, server_log=None,
-               cache_file=None,):
+               cache_file=None, cache_backend=None, max_concurrency=8,
+               max_retries=3, retry_backoff=0.5, timeout=None, ports=None,
+               num_servers=1, server_heap_size='4g', server_threads=None,
+               server_reuse_existing=True, server_warmup_annotators=None,
+               compact=False):
     """Create the client.
 
     Args:
@@ -18,30 +108,116 @@ class CoreNLPClient(object):
       start_server: start the server on first cache miss.
       server_flags: passed to CoreNLPServer.__init__()
       server_log: passed to CoreNLPServer.__init__()
+          (with several servers, used as a prefix of their log files).
       cache_file: load and save cache to this file.
+      cache_backend: 'json' or 'sqlite', see cache.open_cache().
+          By default, chosen from the extension of cache_file.
+      max_concurrency: maximum number of concurrent requests in query_many().
+      max_retries: number of times to retry a request that failed
+          with a connection error, timeout, or 502/503/504 status.
+      retry_backoff: seconds to wait before the first retry;
+          doubles on each subsequent retry.
+      timeout: timeout in seconds for each request (default = none).
+      ports: if provided, a list of ports of several servers on hostname
+          (with start_server, the servers are started on these ports).
+          Requests go to the one with the fewest outstanding requests.
+          A server is only health-checked after a request to it fails
+          to connect; a crashed server that was started here is then
+          restarted.
+      num_servers: without ports, the number of servers, on consecutive
+          ports beginning at port.
+      server_heap_size: JVM heap size of each started server.
+      server_threads: if provided, threads used by each started server.
+      server_reuse_existing: with start_server, use servers that are
+          already running on the ports instead of starting new ones.
+      server_warmup_annotators: with start_server, annotators to preload,
+          see CoreNLPServer.__init__().
+      compact: if True, return AnnotatedDocument objects instead of JSON
+          dicts, and store them in the cache in their compact form
+          (which keeps only the fields AnnotatedDocument stores).
     """
     self.hostname = hostname
     self.port = port
+    if ports:
+      self.ports = list(ports)
+    else:
+      self.ports = [port + i for i in range(num_servers)]
+    self.server_heap_size = server_heap_size
+    self.server_threads = server_threads
+    self.server_reuse_existing = server_reuse_existing
+    self.server_warmup_annotators = server_warmup_annotators
     self.start_server = start_server
     self.server_flags = server_flags
     self.server_log = server_log
     self.server = None
+    self.server_lock = threading.Lock()
+    self.max_concurrency = max_concurrency
+    self.max_retries = max_retries
+    self.retry_backoff = retry_backoff
+    self.timeout = timeout
+    self.balancer = LoadBalancer(urlparse.urlparse(hostname).hostname or hostname,
+                                 self.ports)
+    # One pooled session, so connections are reused across requests
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.ports),
+                                            pool_maxsize=max_concurrency)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.compact = compact
     self.cache_file = cache_file
-    self.has_cache_misses = False
     if cache_file:
-      if os.path.exists(cache_file):
-        with open(cache_file) as f:
-          self.cache = json.load(f)
-      else:
-        self.cache = {}
+      self.cache = open_cache(cache_file, backend=cache_backend)
     else:
       self.cache = None
 
   def save_cache(self):
-    if self.cache_file and self.has_cache_misses:
-      with open(self.cache_file, 'w') as f:
-        json.dump(self.cache, f)
-    self.has_cache_misses = False
+    if self.cache is not None:
+      self.cache.save()
+
+  def _maybe_start_server(self):
+    with self.server_lock:
+      if self.start_server and not self.server:
+        if len(self.ports) > 1:
+          self.server = CoreNLPServerPool(
+              len(self.ports), ports=self.ports, flags=self.server_flags,
+              log_prefix=self.server_log, heap_size=self.server_heap_size,
+              threads=self.server_threads,
+              reuse_existing=self.server_reuse_existing,
+              warmup_annotators=self.server_warmup_annotators)
+          self.balancer.server_pool = self.server
+        else:
+          self.server = CoreNLPServer(
+              port=self.ports[0], flags=self.server_flags,
+              logfile=self.server_log, heap_size=self.server_heap_size,
+              threads=self.server_threads,
+              reuse_existing=self.server_reuse_existing,
+              warmup_annotators=self.server_warmup_annotators)
+        self.server.start()
+
+  def _post(self, data, properties):
+    """Send one request to a server, retrying transient failures."""
+    params = {'properties': str(properties)}
+    for attempt in range(self.max_retries + 1):
+      port = self.balancer.acquire()
+      url = '%s:%d' % (self.hostname, port)
+      try:
+        r = self.session.post(url, params=params, data=data.encode('utf-8'),
+                              timeout=self.timeout)
+        if r.status_code not in RETRY_STATUS_CODES:
+          break
+        error = requests.HTTPError('Server returned status %d' % r.status_code)
+      except requests.ConnectionError as e:
+        self.balancer.mark_down(port)
+        error = e
+      except requests.Timeout as e:
+        error = e
+      finally:
+        self.balancer.release(port)
+      if attempt == self.max_retries:
+        raise error
+      time.sleep(self.retry_backoff * 2 ** attempt)
+    r.encoding = 'utf-8'
+    return json.loads(r.text, strict=False)
 
   def query(self, sents, properties):
     """Most general way to query the server.
@@ -50,26 +226,192 @@ class CoreNLPClient(object):
       sents: Either a string or a list of strings.
       properties: CoreNLP properties to send as part of the request.
     """
-    url = '%s:%d' % (self.hostname, self.port)
-    params = {'properties': str(properties)}
     if isinstance(sents, list):
       data = '\n'.join(sents)
     else:
       data = sents
-    key = '%s\t%s' % (data, str(properties))
-    if self.cache and key in self.cache:
-      return self.cache[key]
-    self.has_cache_misses = True
-    if self.start_server and not self.server:
-      self.server = CoreNLPServer(port=self.port, flags=self.server_flags,
-                                  logfile=self.server_log)
-      self.server.start()
-    r = requests.post(url, params=params, data=data.encode('utf-8'))
-    r.encoding = 'utf-8'
-    json_response = json.loads(r.text, strict=False)
+    cached = self._cache_get(data, properties)
+    if cached is not None:
+      return cached
+    self._maybe_start_server()
+    json_response = self._post(data, properties)
+    return self._cache_put(data, properties, json_response)
+
+  def _wrap(self, value):
+    """Convert a response or cached value to what this client returns."""
+    if self.compact:
+      if is_compact(value):
+        return AnnotatedDocument.from_compact(value)
+      return AnnotatedDocument(value)
+    return value
+
+  def _cache_lookup(self, key):
+    """Get a cached value usable by this client, or None.
+
+    Compact entries keep only some fields, so they live under their own
+    keys (key + COMPACT_KEY_SUFFIX) and are only used by compact clients;
+    compact clients can also use full responses.
+    """
+    if self.compact:
+      value = self.cache.get(key + COMPACT_KEY_SUFFIX)
+      if value is not None:
+        return value
+    value = self.cache.get(key)
+    if value is not None and is_compact(value) and not self.compact:
+      # Written under a full-response key by an older version
+      return None
+    return value
+
+  def _cache_get(self, data, properties):
+    if self.cache is None: return None
+    value = self._cache_lookup('%s\t%s' % (data, properties_key(properties)))
+    if value is None:
+      # Caches written before keys were normalized used str(properties)
+      value = self._cache_lookup('%s\t%s' % (data, str(properties)))
+    if value is None:
+      value = self._cache_get_superset(data, properties)
+    if value is None: return None
+    return self._wrap(value)
+
+  def _cache_get_superset(self, data, properties):
+    """Find a cached response made with a superset of the annotators.
+
+    For example, a query_pos() can be answered by an earlier query_ner()
+    on the same text, since the NER pipeline also runs the POS tagger.
+    """
+    cached_sets = self.cache.get(_subsumption_key(data, properties))
+    if not cached_sets: return None
+    needed = _annotator_set(properties)
+    for annotators in cached_sets:
+      if needed <= _annotator_set({'annotators': annotators}):
+        new_props = dict(properties)
+        new_props['annotators'] = annotators
+        value = self._cache_lookup('%s\t%s' % (data, properties_key(new_props)))
+        if value is not None:
+          return value
+    return None
+
+  def _cache_put(self, data, properties, response):
+    """Cache a raw JSON response; return it as this client returns it."""
+    value = self._wrap(response)
     if self.cache is not None:
-      self.cache[key] = json_response
-    return json_response
+      key = '%s\t%s' % (data, properties_key(properties))
+      if self.compact:
+        self.cache.put(key + COMPACT_KEY_SUFFIX, value.to_compact())
+      else:
+        self.cache.put(key, value)
+      # Record this annotator set, for answering queries with subsets of it
+      sub_key = _subsumption_key(data, properties)
+      cached_sets = self.cache.get(sub_key) or []
+      annotators = properties.get('annotators', '')
+      if annotators not in cached_sets:
+        self.cache.put(sub_key, cached_sets + [annotators])
+    return value
+
+  def query_batched(self, texts, properties, batch_chars=DEFAULT_BATCH_CHARS,
+                    max_concurrency=None):
+    """Annotate each text separately, caching and batching per text.
+
+    Each text (e.g. a sentence or paragraph) is cached on its own, so cache
+    hits don't depend on how a corpus was grouped into requests.  Texts not
+    in the cache are deduplicated, joined with newlines into requests of
+    about batch_chars characters, sent concurrently, and the responses are
+    split back into one response per text.
+
+    Requires properties under which a newline always ends a sentence,
+    as in the standard query_*() methods.  Only sentence-level annotations
+    are returned, so document-level annotators (DOCUMENT_ANNOTATORS, e.g.
+    coref) are rejected: their responses would be cached without the
+    document-level output that query() returns.
+
+    Args:
+      texts: list of strings.
+      properties: CoreNLP properties, shared by all requests.
+      batch_chars: target number of characters per request.
+      max_concurrency: maximum number of concurrent requests.
+    Returns:
+      A list with one response per text, each like the response of query().
+    """
+    if not (properties.get('ssplit.eolonly') in (True, 'true') or
+            properties.get('ssplit.newlineIsSentenceBreak') == 'always'):
+      raise ValueError('query_batched() requires newlines to end sentences')
+    doc_annotators = _annotator_set(properties) & DOCUMENT_ANNOTATORS
+    if doc_annotators:
+      raise ValueError('query_batched() does not support annotators %s' %
+                       ', '.join(sorted(doc_annotators)))
+    results = [None] * len(texts)
+    uncached = collections.OrderedDict()  # text -> list of indices
+    for i, t in enumerate(texts):
+      if t in uncached:
+        uncached[t].append(i)
+        continue
+      cached = self._cache_get(t, properties)
+      if cached is not None:
+        results[i] = cached
+      elif not t.strip():
+        results[i] = self._wrap({'sentences': []})
+      else:
+        uncached[t] = [i]
+    batches = []
+    cur_batch = []
+    cur_chars = 0
+    for t in uncached:
+      if cur_batch and cur_chars + len(t) > batch_chars:
+        batches.append(cur_batch)
+        cur_batch = []
+        cur_chars = 0
+      cur_batch.append(t)
+      cur_chars += len(t) + 1
+    if cur_batch:
+      batches.append(cur_batch)
+    if batches:
+      self._maybe_start_server()
+    def run_batch(batch):
+      return _split_response(self._post('\n'.join(batch), properties), batch)
+    max_concurrency = max_concurrency or self.max_concurrency
+    pool = ThreadPool(max(1, min(max_concurrency, len(batches))))
+    try:
+      for batch, responses in zip(batches, pool.imap(run_batch, batches)):
+        for t, r in zip(batch, responses):
+          value = self._cache_put(t, properties, r)
+          for i in uncached[t]:
+            results[i] = value
+    finally:
+      pool.terminate()
+      pool.join()
+    return results
+
+  def query_iter(self, inputs, properties, max_concurrency=None):
+    """Lazily run query() on each input, with concurrent requests.
+
+    Results are yielded in input order.  At most 2 * max_concurrency
+    inputs are pulled from |inputs| ahead of the results consumed so far,
+    so |inputs| may be an arbitrarily long stream.
+
+    Args:
+      inputs: iterable of inputs, each as in query().
+      properties: CoreNLP properties, shared by all requests.
+      max_concurrency: maximum number of concurrent requests
+          (default = self.max_concurrency).
+    """
+    max_concurrency = max_concurrency or self.max_concurrency
+    pool = ThreadPool(max_concurrency)
+    try:
+      in_flight = collections.deque()
+      for x in inputs:
+        in_flight.append(pool.apply_async(self.query, (x, properties)))
+        if len(in_flight) >= 2 * max_concurrency:
+          yield in_flight.popleft().get()
+      while in_flight:
+        yield in_flight.popleft().get()
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def query_many(self, inputs, properties, max_concurrency=None):
+    """Run query() on each input concurrently, return results in order."""
+    return list(self.query_iter(inputs, properties,
+                                max_concurrency=max_concurrency))
 
   def __enter__(self):
     return self
@@ -77,8 +419,8 @@ class CoreNLPClient(object):
   def __exit__(self, type, value, traceback):
     if self.server:
       self.server.stop()
-    if self.cache_file:
-      self.save_cache()
+    if self.cache is not None:
+      self.cache.close()
 
   def query_pos(self, sents):
     """Standard query for getting POS tags."""
@@ -0,0 +1,257 @@
+"""A compact, columnar representation of CoreNLP responses.
+
+A CoreNLP JSON response holds one dict per token, which takes roughly
+ten times the memory of the text.  An AnnotatedDocument instead stores
+each token attribute as a column: strings are interned as integer ids in
+a Vocabulary per attribute, and character offsets and dependency edges
+are numpy int arrays.  Columns are decoded from the raw JSON lazily, the
+first time they are accessed.
+
+Token indices are global to the document; sentence i spans tokens
+sent_starts[i]:sent_starts[i+1].
+"""
+import collections
+import numpy as np
+import threading
+
+from ..base.vocabulary import Vocabulary
+
+STRING_FIELDS = ('word', 'originalText', 'lemma', 'pos', 'ner', 'before', 'after')
+DEP_TYPE = 'basic-dependencies'
+COMPACT_FORMAT = 'nectar-columnar-1'
+
+# Vocabularies shared by all documents in this process, one per field
+VOCABS = collections.defaultdict(Vocabulary)
+# Guards adding words to vocabularies, since documents may be decoded in
+# several threads (e.g. by CoreNLPClient.query_many())
+_VOCAB_LOCK = threading.Lock()
+
+def _intern(vocab, strs):
+  """Map strings to ids, adding any new ones to vocab."""
+  word2index = vocab.word2index
+  ids = []
+  for s in strs:
+    i = word2index.get(s)
+    if i is None:
+      with _VOCAB_LOCK:
+        if s not in word2index:
+          vocab.add_word_hard(s)
+        i = word2index[s]
+    ids.append(i)
+  return np.array(ids, dtype=np.int32)
+
+class AnnotatedDocument(object):
+  """A CoreNLP-annotated document with columnar, lazily decoded fields."""
+  def __init__(self, response, vocabs=None):
+    """Wrap a CoreNLP JSON response (not copied; decoded lazily).
+
+    Args:
+      response: dict returned by CoreNLP, with a 'sentences' list.
+      vocabs: dict mapping field name to Vocabulary (default = VOCABS).
+    """
+    self.raw = response
+    self.vocabs = VOCABS if vocabs is None else vocabs
+    self.columns = {}  # field -> np.array of ids
+    self._sent_starts = None
+    self._char_offsets = None
+    self._deps = None
+    self._parses = None
+
+  def get_vocab(self, field):
+    """Return the Vocabulary of a field, creating it if needed."""
+    vocab = self.vocabs.get(field)
+    if vocab is None:
+      with _VOCAB_LOCK:
+        if field not in self.vocabs:
+          self.vocabs[field] = Vocabulary()
+        vocab = self.vocabs[field]
+    return vocab
+
+  def _tokens(self):
+    for sent in self.raw['sentences']:
+      for tok in sent['tokens']:
+        yield tok
+
+  @property
+  def sent_starts(self):
+    if self._sent_starts is None:
+      lens = [len(s['tokens']) for s in self.raw['sentences']]
+      self._sent_starts = np.concatenate([[0], np.cumsum(lens)]).astype(np.int32)
+    return self._sent_starts
+
+  def num_sentences(self):
+    return len(self.sent_starts) - 1
+
+  def __len__(self):
+    return int(self.sent_starts[-1])
+
+  def has_field(self, field):
+    if field in self.columns: return True
+    if self.raw is None: return False
+    return any(field in tok for tok in self._tokens())
+
+  def get_ids(self, field):
+    """Return the interned ids of a token field (e.g. 'pos') as an array."""
+    if field not in self.columns:
+      if self.raw is None:
+        raise KeyError('Field "%s" not present' % field)
+      self.columns[field] = _intern(self.get_vocab(field),
+                                    (tok[field] for tok in self._tokens()))
+    return self.columns[field]
+
+  def get_strings(self, field, start=0, end=None):
+    """Return the values of a token field as a list of strings."""
+    vocab = self.get_vocab(field)
+    return [vocab.word_list[i] for i in self.get_ids(field)[start:end]]
+
+  @property
+  def words(self):
+    return self.get_strings('word')
+
+  @property
+  def lemmas(self):
+    return self.get_strings('lemma')
+
+  @property
+  def pos_tags(self):
+    return self.get_strings('pos')
+
+  @property
+  def ner_tags(self):
+    return self.get_strings('ner')
+
+  @property
+  def char_offsets(self):
+    """An (n, 2) int array of [characterOffsetBegin, characterOffsetEnd)."""
+    if self._char_offsets is None:
+      self._char_offsets = np.array(
+          [(t['characterOffsetBegin'], t['characterOffsetEnd'])
+           for t in self._tokens()], dtype=np.int32).reshape((-1, 2))
+    return self._char_offsets
+
+  @property
+  def dependencies(self):
+    """Dependency edges as arrays (governors, dependents, label ids).
+
+    Governor and dependent are global token indices; the governor of a
+    root edge is -1.  Labels are interned in self.get_vocab('dep').
+    """
+    if self._deps is None:
+      govs, deps, labels = [], [], []
+      for sent, start in zip(self.raw['sentences'], self.sent_starts):
+        for e in sent.get(DEP_TYPE, []):
+          govs.append(start + e['governor'] - 1 if e['governor'] else -1)
+          deps.append(start + e['dependent'] - 1)
+          labels.append(e['dep'])
+      self._deps = (np.array(govs, dtype=np.int32),
+                    np.array(deps, dtype=np.int32),
+                    _intern(self.get_vocab('dep'), labels))
+    return self._deps
+
+  @property
+  def parses(self):
+    """The constituency parse string of each sentence, or None."""
+    if self._parses is None:
+      self._parses = [s.get('parse') for s in self.raw['sentences']]
+    return self._parses
+
+  def decode_all(self):
+    """Decode every field and drop the raw JSON."""
+    if self.raw is None: return
+    for field in STRING_FIELDS:
+      if self.has_field(field):
+        self.get_ids(field)
+    self.char_offsets
+    self.dependencies
+    self.parses
+    self.raw = None
+
+  def to_compact(self):
+    """Return a compact, JSON-serializable form, e.g. for caching.
+
+    Ids in the compact form index into its own string table, so it
+    doesn't depend on the vocabularies of this process.
+    """
+    self.decode_all()
+    strings = []
+    string_ids = {}
+    def local_ids(field, ids):
+      vocab = self.get_vocab(field)
+      out = []
+      for i in ids:
+        s = vocab.word_list[i]
+        if s not in string_ids:
+          string_ids[s] = len(strings)
+          strings.append(s)
+        out.append(string_ids[s])
+      return out
+    govs, deps, labels = self._deps
+    return {
+        'format': COMPACT_FORMAT,
+        'sent_starts': self.sent_starts.tolist(),
+        'char_offsets': self._char_offsets.ravel().tolist(),
+        'fields': dict((f, local_ids(f, ids)) for f, ids in self.columns.iteritems()),
+        'deps': [govs.tolist(), deps.tolist(), local_ids('dep', labels)],
+        'parses': self._parses,
+        'strings': strings,
+    }
+
+  @classmethod
+  def from_compact(cls, d, vocabs=None):
+    """Inverse of to_compact()."""
+    doc = cls(None, vocabs=vocabs)
+    strings = d['strings']
+    doc._sent_starts = np.array(d['sent_starts'], dtype=np.int32)
+    doc._char_offsets = np.array(d['char_offsets'], dtype=np.int32).reshape((-1, 2))
+    for f, ids in d['fields'].iteritems():
+      doc.columns[f] = _intern(doc.get_vocab(f), (strings[i] for i in ids))
+    govs, deps, labels = d['deps']
+    doc._deps = (np.array(govs, dtype=np.int32), np.array(deps, dtype=np.int32),
+                 _intern(doc.get_vocab('dep'), (strings[i] for i in labels)))
+    doc._parses = d['parses']
+    return doc
+
+  def to_json(self):
+    """Rebuild a CoreNLP-style response from the stored fields.
+
+    Only the fields this class stores are included.
+    """
+    if self.raw is not None:
+      return self.raw
+    fields = [(f, self.get_strings(f)) for f in self.columns]
+    govs, deps, labels = self._deps
+    label_strs = self.get_dep_labels(labels)
+    sentences = []
+    for i in range(self.num_sentences()):
+      start, end = int(self.sent_starts[i]), int(self.sent_starts[i + 1])
+      tokens = []
+      for j in range(start, end):
+        tok = {'index': j - start + 1,
+               'characterOffsetBegin': int(self._char_offsets[j, 0]),
+               'characterOffsetEnd': int(self._char_offsets[j, 1])}
+        for f, vals in fields:
+          tok[f] = vals[j]
+        tokens.append(tok)
+      sent = {'index': i, 'tokens': tokens}
+      in_sent = (deps >= start) & (deps < end)
+      if in_sent.any():
+        sent[DEP_TYPE] = [
+            {'dep': label_strs[k],
+             'governor': int(govs[k]) - start + 1 if govs[k] >= 0 else 0,
+             'dependent': int(deps[k]) - start + 1}
+            for k in np.flatnonzero(in_sent)]
+      if self._parses[i] is not None:
+        sent['parse'] = self._parses[i]
+      sentences.append(sent)
+    return {'sentences': sentences}
+
+  def get_dep_labels(self, label_ids=None):
+    """Return dependency labels as strings."""
+    if label_ids is None:
+      label_ids = self.dependencies[2]
+    vocab = self.get_vocab('dep')
+    return [vocab.word_list[i] for i in label_ids]
+
+def is_compact(value):
+  """Return whether a cached value is in AnnotatedDocument's compact form."""
+  return isinstance(value, dict) and value.get('format') == COMPACT_FORMAT
@@ -0,0 +1,138 @@
+"""Run several CoreNLP servers and balance requests across them."""
+import socket
+import threading
+import time
+
+from server import CoreNLPServer, LIB_PATH
+
+class CoreNLPServerPool(object):
+  """Runs N CoreNLP servers, by default on consecutive ports."""
+  def __init__(self, num_servers, base_port=7000, lib_path=LIB_PATH,
+               flags=None, log_prefix=None, heap_size='4g', threads=None,
+               reuse_existing=False, warmup_annotators=None, ports=None):
+    """Create the pool.
+
+    Args:
+      num_servers: Number of server instances.
+      base_port: Port of the first server; the i-th uses base_port + i.
+      lib_path: The path to the CoreNLP *.jar files.
+      flags: Passed to each CoreNLPServer.
+      log_prefix: If provided, server i logs to '%s.%d' % (log_prefix, i).
+      heap_size: Maximum JVM heap size of each server, e.g. '4g'.
+      threads: If provided, number of threads each server uses.
+      reuse_existing: Passed to each CoreNLPServer.
+      warmup_annotators: Passed to each CoreNLPServer.
+      ports: If provided, the list of ports of the servers, used instead
+          of num_servers consecutive ports from base_port.
+    """
+    if ports:
+      self.ports = list(ports)
+    else:
+      self.ports = [base_port + i for i in range(num_servers)]
+    self.servers = []
+    for i, port in enumerate(self.ports):
+      logfile = '%s.%d' % (log_prefix, i) if log_prefix else None
+      self.servers.append(CoreNLPServer(
+          port=port, lib_path=lib_path, flags=flags, logfile=logfile,
+          heap_size=heap_size, threads=threads, reuse_existing=reuse_existing,
+          warmup_annotators=warmup_annotators))
+    self.lock = threading.Lock()
+
+  def start(self):
+    """Start all servers, in parallel."""
+    threads = [threading.Thread(target=s.start) for s in self.servers]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+
+  def restart_if_dead(self, port):
+    """Restart the server on the given port if its process has died.
+
+    Returns:
+      True if the server was restarted.
+    """
+    server = self.servers[self.ports.index(port)]
+    with self.lock:
+      if server.process is None or server.is_running():
+        return False
+      server.restart()
+      return True
+
+  def stop(self):
+    for s in self.servers:
+      s.stop()
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.stop()
+
+class LoadBalancer(object):
+  """Picks the healthy server with the fewest outstanding requests.
+
+  A server whose request failed with a connection error is marked down.
+  It is probed again after recheck_interval seconds, and used again once
+  it accepts connections.  Servers are only checked after such a failure:
+  there is no periodic probe of servers that look healthy.
+  """
+  def __init__(self, host, ports, server_pool=None, recheck_interval=5.0):
+    """Create the balancer.
+
+    Args:
+      host: hostname of the servers, e.g. 'localhost'.
+      ports: list of server ports.
+      server_pool: if provided, a CoreNLPServerPool whose crashed servers
+          are restarted when they are marked down.
+      recheck_interval: seconds before a down server is probed again.
+    """
+    self.host = host
+    self.ports = list(ports)
+    self.server_pool = server_pool
+    self.recheck_interval = recheck_interval
+    self.outstanding = dict((p, 0) for p in self.ports)
+    self.down_since = {}  # port -> time it was marked down
+    self.lock = threading.Lock()
+
+  def _probe(self, port):
+    try:
+      s = socket.create_connection((self.host, port), timeout=1.0)
+      s.close()
+      return True
+    except socket.error:
+      return False
+
+  def acquire(self):
+    """Choose a port for a new request; call release() when done."""
+    now = time.time()
+    with self.lock:
+      to_probe = [p for p, t in self.down_since.iteritems()
+                  if now - t >= self.recheck_interval]
+      for p in to_probe:
+        self.down_since[p] = now  # Don't let other threads probe it too
+    for p in to_probe:
+      if self._probe(p):
+        with self.lock:
+          self.down_since.pop(p, None)
+    with self.lock:
+      candidates = [p for p in self.ports if p not in self.down_since]
+      if not candidates:
+        # Everything is down; try them anyway rather than failing outright
+        candidates = self.ports
+      port = min(candidates, key=lambda p: self.outstanding[p])
+      self.outstanding[port] += 1
+    return port
+
+  def release(self, port):
+    with self.lock:
+      self.outstanding[port] -= 1
+
+  def mark_down(self, port):
+    """Record that a request to port failed to connect."""
+    with self.lock:
+      self.down_since[port] = time.time()
+    if self.server_pool and self.server_pool.restart_if_dead(port):
+      with self.lock:
+        self.down_since.pop(port, None)
@@ -1,8 +1,7 @@
 """Run a CoreNLP Server."""
 import atexit
-import errno
 import os
-import socket
+import requests
 import subprocess
 import sys
 import time
@@ -11,10 +10,13 @@ LIB_PATH = os.path.join(
     os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))),
     'lib/stanford-corenlp/*')
 DEVNULL = open(os.devnull, 'wb')
+WARMUP_TEXT = 'Stanford University is located in California .'
 
 class CoreNLPServer(object):
   """An object that runs the CoreNLP server."""
-  def __init__(self, port=7000, lib_path=LIB_PATH, flags=None, logfile=None):
+  def __init__(self, port=7000, lib_path=LIB_PATH, flags=None, logfile=None,
+               heap_size='4g', threads=None, reuse_existing=False,
+               warmup_annotators=None, start_timeout=300.0):
     """Create the CoreNLPServer object.
 
     Args:
@@ -22,11 +24,26 @@ class CoreNLPServer(object):
       flags: If provided, pass this list of additional flags to the java server.
       logfile: If provided, log stderr to this file.
       lib_path: The path to the CoreNLP *.jar files.
+      heap_size: Maximum JVM heap size, e.g. '4g'.
+      threads: If provided, number of threads the server uses.
+      reuse_existing: If True and a server already answers on the port,
+          use it instead of starting a new one.
+      warmup_annotators: If provided, a comma-separated annotator list
+          (e.g. 'tokenize,ssplit,pos,ner,depparse,parse') to run once on
+          startup, so their models are loaded before the first real query.
+      start_timeout: Seconds to wait for the server to become ready.
     """
     self.port = port
-    self.lib_path = LIB_PATH
+    self.lib_path = lib_path
+    self.heap_size = heap_size
+    self.threads = threads
+    self.reuse_existing = reuse_existing
+    self.warmup_annotators = warmup_annotators
+    self.start_timeout = start_timeout
     self.process = None
     self.p_stderr = None
+    self.logfile = logfile
+    self.registered_atexit = False
     if flags:
       self.flags = flags
     else:
@@ -36,31 +53,80 @@ class CoreNLPServer(object):
     else:
       self.logfd = DEVNULL
 
+  def url(self):
+    return 'http://localhost:%d' % self.port
+
+  def is_ready(self):
+    """Return whether a server answers HTTP requests on the port."""
+    try:
+      requests.get(self.url(), timeout=1.0)
+      return True
+    except requests.RequestException:
+      return False
+
+  def wait_until_ready(self):
+    """Poll the server with exponential backoff until it answers."""
+    t0 = time.time()
+    delay = 0.05
+    while not self.is_ready():
+      if self.process and self.process.poll() is not None:
+        raise RuntimeError('CoreNLP server exited with code %d during startup'
+                           % self.process.returncode)
+      if time.time() - t0 > self.start_timeout:
+        raise RuntimeError('CoreNLP server not ready after %.0fs'
+                           % self.start_timeout)
+      time.sleep(delay)
+      delay = min(2 * delay, 1.0)
+
+  def warmup(self, annotators=None):
+    """Run the annotators once, so their models get loaded."""
+    annotators = annotators or self.warmup_annotators
+    t0 = time.time()
+    properties = {'annotators': annotators, 'outputFormat': 'json'}
+    r = requests.post(self.url(), params={'properties': str(properties)},
+                      data=WARMUP_TEXT)
+    r.raise_for_status()
+    print >> sys.stderr, 'Warmed up CoreNLP server on port %d (%s) in %.1fs' % (
+        self.port, annotators, time.time() - t0)
+
   def start(self, flags=None):
     """Start up the server on a separate process."""
+    if self.reuse_existing and self.is_ready():
+      print >> sys.stderr, 'Using existing CoreNLP server on port %d' % self.port
+      return
     print >> sys.stderr, 'Using lib directory %s' % self.lib_path
+    t0 = time.time()
     if not flags:
       flags = self.flags
+    if self.threads:
+      flags = flags + ['-threads', str(self.threads)]
     p = subprocess.Popen(
-        ['java', '-mx4g', '-cp', self.lib_path,
+        ['java', '-mx%s' % self.heap_size, '-cp', self.lib_path,
          'edu.stanford.nlp.pipeline.StanfordCoreNLPServer',
          '--port', str(self.port)] + flags,
         stderr=self.logfd, stdout=self.logfd)
     self.process = p
-    atexit.register(self.stop)  
+    if not self.registered_atexit:
+      atexit.register(self.stop)
+      self.registered_atexit = True
+    self.wait_until_ready()
+    print >> sys.stderr, 'Started CoreNLP server on port %d in %.1fs' % (
+        self.port, time.time() - t0)
+    if self.warmup_annotators:
+      self.warmup()
 
-    # Keep trying to connect until the server is up
-    s = socket.socket()
-    while True:
-      time.sleep(1)
-      try:
-        s.connect(('127.0.0.1', self.port))
-      except socket.error as e:
-        if e.errno != errno.ECONNREFUSED:
-          # Something other than Connection refused means server is running
-          break
-    s.close()
+  def is_running(self):
+    """Return whether the server process is still alive."""
+    return self.process is not None and self.process.poll() is None
 
+  def restart(self):
+    """Stop the server if it is running, then start it again."""
+    if self.is_running():
+      self.process.terminate()
+      self.process.wait()
+    if self.logfile and self.logfd.closed:
+      self.logfd = open(self.logfile, 'ab')
+    self.start()
 
   def stop(self):
     """Stop running the server on a separate process."""
@@ -1,4 +1,14 @@
 """CoreNLP-related utilities."""
+import array
+import bisect
+import copy
+import itertools
+import multiprocessing
+import numpy as np
+import re
+
+from ..base.util import MIN_PARALLEL_ITEMS, parallel_map
+
 def rejoin(tokens, sep=None):
   """Rejoin tokens into the original sentence.
   
@@ -15,12 +25,98 @@ def rejoin(tokens, sep=None):
     # Use the given separator instead
     return sep.join(t['originalText'] for t in tokens)
 
+class TokenAlignment(object):
+  """Maps between character offsets and token indices of a document.
+
+  Built from the characterOffsetBegin/End of each token.  As in rejoin(),
+  the whitespace before a token belongs to that token, so a character in
+  a gap between tokens maps to the following token.  Token indices count
+  across all sentences; offsets are in CoreNLP's units.
+  """
+  def __init__(self, starts, ends):
+    """Create the index.
+
+    Args:
+      starts: characterOffsetBegin of each token, in order.
+      ends: characterOffsetEnd of each token.
+    """
+    self.starts = np.asarray(starts, dtype=np.int64)
+    self.ends = np.asarray(ends, dtype=np.int64)
+    # Lists for bisect, which is faster than numpy on single lookups
+    self._start_list = self.starts.tolist()
+    self._end_list = self.ends.tolist()
+
+  @classmethod
+  def from_tokens(cls, tokens):
+    """Build from a list of CoreNLP token dicts."""
+    return cls([t['characterOffsetBegin'] for t in tokens],
+               [t['characterOffsetEnd'] for t in tokens])
+
+  @classmethod
+  def from_response(cls, response):
+    """Build from a CoreNLP response or an AnnotatedDocument."""
+    if hasattr(response, 'char_offsets'):
+      offsets = response.char_offsets
+      return cls(offsets[:, 0], offsets[:, 1])
+    return cls.from_tokens([t for s in response['sentences'] for t in s['tokens']])
+
+  def __len__(self):
+    return len(self._start_list)
+
+  def char_to_token(self, c):
+    """Return the index of the token at (or following) character c, or None."""
+    i = bisect.bisect_right(self._end_list, c)
+    if i == len(self._end_list): return None
+    return i
+
+  def token_to_char(self, i):
+    """Return the character span [start, end) of token i."""
+    return self._start_list[i], self._end_list[i]
+
+  def span_to_tokens(self, start, end):
+    """Return the token span [i, j) overlapping the character span [start, end).
+
+    Whitespace at either end of the character span is ignored; a span
+    containing only whitespace gives an empty token span.
+    """
+    i = bisect.bisect_right(self._end_list, start)
+    j = bisect.bisect_left(self._start_list, end)
+    return i, max(i, j)
+
+  def tokens_to_span(self, i, j):
+    """Return the character span [start, end) of tokens [i, j)."""
+    return self._start_list[i], self._end_list[j - 1]
+
+  def spans_to_tokens(self, starts, ends):
+    """Vectorized span_to_tokens(); returns arrays (token starts, token ends)."""
+    i = np.searchsorted(self.ends, starts, side='right')
+    j = np.searchsorted(self.starts, ends, side='left')
+    return i, np.maximum(i, j)
+
+  def tokens_to_spans(self, token_starts, token_ends):
+    """Vectorized tokens_to_span(); returns arrays (char starts, char ends)."""
+    return (self.starts[np.asarray(token_starts)],
+            self.ends[np.asarray(token_ends) - 1])
+
+# A paren, or a run of characters other than parens, spaces and newlines
+_PARSE_TOKEN_RE = re.compile(r'[()]|[^() \n]+')
+
+def _from_corenlp(args):
+  cls, s, func = args
+  tree = cls.from_corenlp(s)
+  if func:
+    return func(tree)
+  # Deep trees can't be pickled recursively, and are slow to unpickle
+  return tree._to_postorder()
+
 class ConstituencyParse(object):
   """A CoreNLP constituency parse (or a node in a parse tree).
   
   Word-level constituents have |word| and |index| set and no children.
   Phrase-level constituents have no |word| or |index| and have at least one child.
   """
+  __slots__ = ('tag', 'children', 'word', 'index')
+
   def __init__(self, tag, children=None, word=None, index=None):
     self.tag = tag
     if children:
@@ -30,37 +126,125 @@ class ConstituencyParse(object):
     self.word = word
     self.index = index
 
-  @classmethod
-  def _recursive_parse_corenlp(cls, tokens, i, j):
-    orig_i = i
-    if tokens[i] == '(':
-      tag = tokens[i + 1]
-      children = []
-      i = i + 2
-      while True:
-        child, i, j = cls._recursive_parse_corenlp(tokens, i, j)
-        if isinstance(child, cls):
-          children.append(child)
-          if tokens[i] == ')': 
-            return cls(tag, children), i + 1, j
-        else:
-          if tokens[i] != ')':
-            raise ValueError('Expected ")" following leaf')
-          return cls(tag, word=child, index=j), i + 1, j + 1
-    else:
-      # Only other possibility is it's a word
-      return tokens[i], i + 1, j
+  def __getstate__(self):
+    return (self.tag, self.children, self.word, self.index)
+
+  def __setstate__(self, state):
+    self.tag, self.children, self.word, self.index = state
 
   @classmethod
   def from_corenlp(cls, s):
     """Parses the "parse" attribute returned by CoreNLP parse annotator."""
     # "parse": "(ROOT\n  (SBARQ\n    (WHNP (WDT What)\n      (NP (NN portion)\n        (PP (IN                       of)\n          (NP\n            (NP (NNS households))\n            (PP (IN in)\n              (NP (NNP             Jacksonville)))))))\n    (SQ\n      (VP (VBP have)\n        (NP (RB only) (CD one) (NN person))))\n    (. ?        )))",
-    s_spaced = s.replace('\n', ' ').replace('(', ' ( ').replace(')', ' ) ')
-    tokens = [t for t in s_spaced.split(' ') if t]
-    tree, index, num_words = cls._recursive_parse_corenlp(tokens, 0, 0)
-    if index != len(tokens):
-      raise ValueError('Only parsed %d of %d tokens' % (index, len(tokens)))
-    return tree
+    tokens = _PARSE_TOKEN_RE.findall(s)
+    n = len(tokens)
+    stack = []  # (tag, children) of each open phrase
+    num_words = 0
+    i = 0
+    while i < n:
+      tok = tokens[i]
+      if tok == '(':
+        if i + 2 >= n:
+          raise ValueError('Unexpected end of parse')
+        tag = tokens[i + 1]
+        word = tokens[i + 2]
+        if word == '(':
+          stack.append((tag, []))
+          i += 2
+          continue
+        if word == ')' or i + 3 >= n or tokens[i + 3] != ')':
+          raise ValueError('Expected ")" following leaf')
+        node = cls(tag, word=word, index=num_words)
+        num_words += 1
+        i += 4
+      elif tok == ')':
+        if not stack:
+          raise ValueError('Unmatched ")" at token %d' % i)
+        tag, children = stack.pop()
+        node = cls(tag, children)
+        i += 1
+      else:
+        raise ValueError('Unexpected word "%s" outside a leaf' % tok)
+      if stack:
+        stack[-1][1].append(node)
+      elif i != n:
+        raise ValueError('Only parsed %d of %d tokens' % (i, n))
+      else:
+        return node
+    raise ValueError('Unexpected end of parse')
+
+  def _to_postorder(self):
+    """Encode the tree compactly as (tags, words, arities), in postorder.
+
+    tags and words are space-separated strings (parse tokens never contain
+    spaces) and arities is an array of child counts, so the encoding
+    pickles without recursion and unpickles almost for free.
+    """
+    tags = []
+    words = []
+    arities = array.array('i')
+    stack = [(self, False)]
+    while stack:
+      node, expanded = stack.pop()
+      if node.children and not expanded:
+        stack.append((node, True))
+        stack.extend((c, False) for c in reversed(node.children))
+        continue
+      tags.append(node.tag)
+      if node.children:
+        arities.append(len(node.children))
+      else:
+        words.append(node.word)
+        arities.append(0)
+    return ' '.join(tags), ' '.join(words), arities
+
+  @classmethod
+  def _from_postorder(cls, encoded):
+    """Inverse of _to_postorder()."""
+    tags, words, arities = encoded
+    words = iter(words.split(' '))
+    stack = []
+    num_words = 0
+    for tag, n in itertools.izip(tags.split(' '), arities):
+      if n:
+        node = cls(tag, stack[-n:])
+        del stack[-n:]
+      else:
+        node = cls(tag, word=next(words), index=num_words)
+        num_words += 1
+      stack.append(node)
+    return stack[0]
+
+  @classmethod
+  def from_corenlp_many(cls, strs, num_procs=None, chunksize=None, func=None):
+    """Parse many "parse" strings, in parallel if there are enough of them.
+
+    Trees are sent back from the workers in a compact flat encoding, but
+    rebuilding them here still costs about as much as a serial parse.  If
+    only something computed from each tree is needed (e.g. features),
+    pass func to compute it in the workers instead.
+
+    Args:
+      strs: a list of strings, as passed to from_corenlp().
+      num_procs: number of worker processes (default = number of CPUs).
+      chunksize: number of strings sent to a worker at once.
+      func: if provided, a function (picklable, i.e. defined at module
+          level) applied to each tree in the workers.
+    Returns:
+      A list of trees (or of func(tree) with func), in the order of strs.
+    """
+    if not func and (len(strs) < MIN_PARALLEL_ITEMS or
+                     (num_procs or multiprocessing.cpu_count()) == 1):
+      return [cls.from_corenlp(s) for s in strs]  # No need to encode trees
+    results = parallel_map(_from_corenlp, [(cls, s, func) for s in strs],
+                           num_procs=num_procs, chunksize=chunksize)
+    if func:
+      return results
+    return [cls._from_postorder(x) for x in results]
+
+  def to_flat(self):
+    """Compile this tree into a FlatParse, for fast span queries."""
+    return FlatParse.from_tree(self)
 
   def is_singleton(self):
     if self.word: return True
@@ -113,3 +297,175 @@ class ConstituencyParse(object):
     if i != len(new_words):
       raise ValueError('len(new_words) == %d != i == %d' % (len(new_words), i))
     return new_tree
+
+class FlatParse(object):
+  """A constituency parse compiled into flat arrays.
+
+  Nodes are numbered in preorder, so node 0 is the root and every node
+  comes before its descendants.  Each array has one entry per node:
+    parent: the parent node, or -1 for the root.
+    first_child: the first child, or -1 for word-level nodes.
+    next_sibling: the next child of the same parent, or -1.
+    tag_ids: index of the node's tag in tag_list.
+    starts, ends: the node covers tokens [start, end).
+  words[i] is the i-th word of the sentence and leaves[i] is its node.
+
+  The structure arrays are never modified, so copies (e.g. from
+  replace_words()) share them.
+  """
+  def __init__(self, parent, first_child, next_sibling, tag_ids, starts, ends,
+               tag_list, words, leaves):
+    self.parent = parent
+    self.first_child = first_child
+    self.next_sibling = next_sibling
+    self.tag_ids = tag_ids
+    self.starts = starts
+    self.ends = ends
+    self.tag_list = tag_list
+    self.tag_index = dict((t, i) for i, t in enumerate(tag_list))
+    self.words = words
+    self.leaves = leaves
+    # Map each span to its highest node (e.g. NP rather than NN in "(NP (NN x))")
+    self.span_to_node = {}
+    for u in xrange(len(parent) - 1, -1, -1):
+      self.span_to_node[(int(starts[u]), int(ends[u]))] = u
+    self._phrases = {}
+
+  @classmethod
+  def from_tree(cls, tree):
+    """Compile a ConstituencyParse."""
+    parent = []
+    first_child = []
+    next_sibling = []
+    last_child = []
+    tag_ids = []
+    starts = []
+    tag_index = {}
+    tag_list = []
+    words = []
+    leaves = []
+    stack = [(tree, -1)]
+    while stack:
+      node, p = stack.pop()
+      u = len(parent)
+      parent.append(p)
+      first_child.append(-1)
+      next_sibling.append(-1)
+      last_child.append(-1)
+      if p >= 0:
+        if first_child[p] < 0:
+          first_child[p] = u
+        else:
+          next_sibling[last_child[p]] = u
+        last_child[p] = u
+      if node.tag not in tag_index:
+        tag_index[node.tag] = len(tag_list)
+        tag_list.append(node.tag)
+      tag_ids.append(tag_index[node.tag])
+      starts.append(len(words))
+      if node.children:
+        for c in reversed(node.children):
+          stack.append((c, u))
+      else:
+        words.append(node.word)
+        leaves.append(u)
+    # Descendants come later in preorder, so fill in ends from the back
+    ends = [0] * len(parent)
+    for u in xrange(len(parent) - 1, -1, -1):
+      if first_child[u] < 0:
+        ends[u] = starts[u] + 1
+      else:
+        ends[u] = ends[last_child[u]]
+    def arr(x):
+      return np.array(x, dtype=np.int32)
+    return cls(arr(parent), arr(first_child), arr(next_sibling), arr(tag_ids),
+               arr(starts), arr(ends), tag_list, words, arr(leaves))
+
+  @classmethod
+  def from_corenlp(cls, s):
+    """Parses the "parse" attribute returned by CoreNLP parse annotator."""
+    return cls.from_tree(ConstituencyParse.from_corenlp(s))
+
+  def __len__(self):
+    """The number of nodes."""
+    return len(self.parent)
+
+  def num_words(self):
+    return len(self.words)
+
+  def get_tag(self, u):
+    return self.tag_list[self.tag_ids[u]]
+
+  def is_word(self, u):
+    return self.first_child[u] < 0
+
+  def get_children(self, u):
+    c = self.first_child[u]
+    children = []
+    while c >= 0:
+      children.append(int(c))
+      c = self.next_sibling[c]
+    return children
+
+  def get_span(self, u):
+    return int(self.starts[u]), int(self.ends[u])
+
+  def get_node(self, start, end):
+    """Return the highest node spanning exactly [start, end), or None."""
+    return self.span_to_node.get((start, end))
+
+  def get_covering_node(self, start, end):
+    """Return the highest node among those with the smallest span covering [start, end)."""
+    if not 0 <= start < end <= len(self.words):
+      raise ValueError('Invalid span [%d, %d) of %d words' % (
+          start, end, len(self.words)))
+    u = self.leaves[start]
+    while self.ends[u] < end:
+      u = self.parent[u]
+    return self.span_to_node[self.get_span(u)]
+
+  def get_nodes_with_tag(self, tag):
+    """Return an array of the nodes with the given tag, in preorder."""
+    if tag not in self.tag_index:
+      return np.zeros(0, dtype=np.int32)
+    return np.flatnonzero(self.tag_ids == self.tag_index[tag])
+
+  def get_spans_with_tag(self, tag):
+    """Return arrays (starts, ends) of the spans of nodes with the given tag."""
+    nodes = self.get_nodes_with_tag(tag)
+    return self.starts[nodes], self.ends[nodes]
+
+  def get_phrase(self, u=0):
+    """Same as ConstituencyParse.get_phrase() for node u; memoized."""
+    if u not in self._phrases:
+      start, end = self.get_span(u)
+      toks = [self.words[start]]
+      for w in self.words[start + 1:end]:
+        if w.startswith("'"):
+          toks.append(w)
+        else:
+          toks.append(' ' + w)
+      self._phrases[u] = ''.join(toks)
+    return self._phrases[u]
+
+  def replace_words(self, new_words):
+    """Return a copy of this parse with new words replacing old ones."""
+    if len(new_words) != len(self.words):
+      raise ValueError('len(new_words) == %d != %d' % (
+          len(new_words), len(self.words)))
+    new_parse = copy.copy(self)
+    new_parse.words = list(new_words)
+    new_parse._phrases = {}
+    return new_parse
+
+  def to_tree(self):
+    """Convert back to a ConstituencyParse."""
+    nodes = [None] * len(self.parent)
+    for u in xrange(len(self.parent) - 1, -1, -1):
+      tag = self.tag_list[self.tag_ids[u]]
+      if self.first_child[u] < 0:
+        start = int(self.starts[u])
+        nodes[u] = ConstituencyParse(tag, word=self.words[start], index=start)
+      else:
+        nodes[u] = ConstituencyParse(tag, [nodes[c] for c in self.get_children(u)])
+    return nodes[0]
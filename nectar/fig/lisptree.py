@@ -1,63 +1,351 @@
-"""Utilities for handling fig LispTree objects."""
+"""Utilities for handling fig LispTree objects.
 
-def tokenize(s):
+A LispTree is either a string (a leaf) or a tuple of LispTrees.
+"""
+import multiprocessing
+import numpy as np
+import os
+import re
+
+from ..base.util import parallel_imap
+
+# Tokens are scanned with one regex.  Only ' ' separates tokens; a
+# backslash escapes the next character, inside or outside quotes.
+_TOKEN_RE = re.compile(r'''
+    (?P<open>\()
+  | (?P<close>\))
+  | (?P<space>\ +)
+  | "(?P<quoted>(?:[^"\\]|\\.)*)(?P<endquote>")?
+  | (?P<bare>(?:[^ ()"\\]|\\.)+)
+  | (?P<trailing>\\)  # A backslash at the very end, escaping nothing
+''', re.VERBOSE | re.DOTALL)
+_ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+_NEEDS_QUOTES_RE = re.compile(r'[ ()"\\]')
+
+class _Literal(object):
+  """A quoted "(" or ")", so it isn't mistaken for a paren by _parse()."""
+  __slots__ = ('value',)
+  def __init__(self, value):
+    self.value = value
+
+def _leaf(value):
+  if value == '(' or value == ')':
+    return _Literal(value)
+  return value
+
+def _unescape(s):
+  if '\\' in s:
+    return _ESCAPE_RE.sub(r'\1', s)
+  return s
+
+def _split_parens(s):
+  return filter(None, s.replace('(', ' ( ').replace(')', ' ) ').split(' '))
+
+def _scan_simple(s):
+  """_scan() for strings without backslashes: split around the quotes."""
+  parts = s.split('"')
   toks = []
-  cur_chars = []
-  inside_str = False
-  inside_escape = False
-  for c in s:
-    if inside_str:
-      if inside_escape:
-        inside_escape = False
-        cur_chars.append(c)
-      else:
-        if c == '"':
-          inside_str = False
-          toks.append(''.join(cur_chars))
-          cur_chars = []
-        elif c == '\\':
-          inside_escape = True
-        else:
-          cur_chars.append(c)
-    else:
-      if inside_escape:
-        inside_escape = False
-        cur_chars.append(c)
-      else:
-        if c in ('(', ')'):
-          if cur_chars:
-            toks.append(''.join(cur_chars))
-            cur_chars = []
-          toks.append(c)
-        elif c == ' ':
-          if cur_chars:
-            toks.append(''.join(cur_chars))
-            cur_chars = []
-        elif c == '"':
-          if cur_chars:
-            raise ValueError('" character found in middle of token')
-          inside_str = True
-        elif c == '\\':
-          inside_escape = True
-        else:
-          cur_chars.append(c)
-  if cur_chars:
-    toks.append(''.join(cur_chars))
+  last = len(parts) - 1
+  for i, part in enumerate(parts):
+    if i % 2 == 0:
+      if i < last and part and part[-1] not in ' ()':
+        raise ValueError('" character found in middle of token')
+      toks.extend(_split_parens(part))
+    elif part or i < last:
+      # An unterminated string (i == last) is only kept if non-empty
+      toks.append(_leaf(part))
   return toks
 
+def _scan(s):
+  """Tokenize s into '(', ')' and leaves; quoted parens become _Literals."""
+  if '\\' not in s:
+    return _scan_simple(s)
+  toks = []
+  for m in _TOKEN_RE.finditer(s):
+    kind = m.lastgroup
+    if kind == 'open':
+      toks.append('(')
+    elif kind == 'close':
+      toks.append(')')
+    elif kind == 'bare':
+      if s[m.end():m.end() + 1] == '"':
+        raise ValueError('" character found in middle of token')
+      toks.append(_unescape(m.group('bare')))
+    elif kind == 'endquote':
+      toks.append(_leaf(_unescape(m.group('quoted'))))
+    elif kind == 'quoted':
+      # An unterminated string runs to the end, and is kept if non-empty
+      if m.group('quoted'):
+        toks.append(_leaf(_unescape(m.group('quoted'))))
+  return toks
+
+def tokenize(s):
+  return [t.value if isinstance(t, _Literal) else t for t in _scan(s)]
+
+def _parse(toks, i=0):
+  """Parse the tree starting at toks[i]; return (tree, index after it)."""
+  stack = []  # Children of each open paren
+  n = len(toks)
+  while i < n:
+    tok = toks[i]
+    i += 1
+    if tok == '(':
+      stack.append([])
+      continue
+    if tok == ')':
+      if not stack:
+        raise ValueError('Unmatched ")" in LispTree')
+      tree = tuple(stack.pop())
+    elif isinstance(tok, _Literal):
+      tree = tok.value
+    else:
+      tree = tok
+    if not stack:
+      return tree, i
+    stack[-1].append(tree)
+  raise ValueError('Unexpected end of LispTree')
+
 def from_string(s):
   """Parse a Java fig LispTree from a string."""
-  toks = tokenize(s)
-  def recurse(i):
-    if toks[i] == '(':
-      subtrees = []
-      j = i+1 
-      while True:
-        subtree, j = recurse(j)
-        subtrees.append(subtree)
-        if toks[j] == ')':
-          return tuple(subtrees), j + 1 
-    else:
-      return toks[i], i+1 
-  lisp_tree, final_ind = recurse(0)
+  lisp_tree, final_ind = _parse(_scan(s))
   return lisp_tree
+
+def _quote(leaf):
+  if leaf and not _NEEDS_QUOTES_RE.search(leaf):
+    return leaf
+  return '"%s"' % leaf.replace('\\', '\\\\').replace('"', '\\"')
+
+_END = object()  # Marks the end of a tuple in to_string()
+
+def to_string(lisp_tree):
+  """Serialize a LispTree, so that from_string(to_string(t)) == t."""
+  parts = []
+  stack = [lisp_tree]
+  after_open = True  # Whether the next token needs no leading space
+  while stack:
+    tree = stack.pop()
+    if tree is _END:
+      parts.append(')')
+      after_open = False
+      continue
+    if not after_open:
+      parts.append(' ')
+    if isinstance(tree, (tuple, list)):
+      parts.append('(')
+      stack.append(_END)
+      stack.extend(reversed(tree))
+      after_open = True
+    else:
+      parts.append(_quote(tree))
+      after_open = False
+  return ''.join(parts)
+
+# Characters that matter when finding where top-level trees end
+_STRUCTURE_RE = re.compile(r'[()"\\]')
+_STRING_END_RE = re.compile(r'["\\]')
+# Quoted strings and escapes (kept as they are), or other whitespace
+_LINE_BREAK_RE = re.compile(r'("(?:[^"\\]|\\.)*"?|\\.)|[\t\r\n]+', re.DOTALL)
+READ_CHUNK_SIZE = 1 << 20
+MAX_SHARD_SIZE = 1 << 24  # Bytes of file per parallel_imap() task
+
+def _iter_records(f, chunk_size=READ_CHUNK_SIZE, end=None):
+  """Yield (byte offset, text) of each top-level tree in a file.
+
+  The file is read in chunks, from its current position up to byte
+  offset end (default = the end of the file), so memory is bounded by the
+  size of the largest tree.  Only whitespace may appear between trees.
+  """
+  offset = f.tell()  # Of the current chunk
+  depth = 0
+  in_str = False
+  escape = False
+  pieces = []  # Text of the current tree from earlier chunks
+  record_start = None
+  while True:
+    if end is not None:
+      chunk_size = min(chunk_size, end - offset)
+      if chunk_size <= 0: break
+    chunk = f.read(chunk_size)
+    if not chunk: break
+    piece_start = 0
+    pos = 0
+    if escape:
+      escape = False
+      pos = 1
+    while True:
+      if in_str:
+        m = _STRING_END_RE.search(chunk, pos)
+      else:
+        m = _STRUCTURE_RE.search(chunk, pos)
+      if depth == 0 and chunk[pos:m.start() if m else None].strip():
+        raise ValueError('Text outside of a LispTree at byte %d' % (offset + pos))
+      if m is None: break
+      p = m.start()
+      c = chunk[p]
+      if c == '\\':
+        if depth == 0:
+          raise ValueError('Text outside of a LispTree at byte %d' % (offset + p))
+        if p + 1 < len(chunk):
+          pos = p + 2
+        else:
+          escape = True
+          pos = p + 1
+        continue
+      pos = p + 1
+      if in_str:
+        in_str = False  # c is the closing quote
+      elif c == '"':
+        if depth == 0:
+          raise ValueError('Text outside of a LispTree at byte %d' % (offset + p))
+        in_str = True
+      elif c == '(':
+        if depth == 0:
+          record_start = offset + p
+          piece_start = p
+          pieces = []
+        depth += 1
+      else:
+        if depth == 0:
+          raise ValueError('Unmatched ")" at byte %d' % (offset + p))
+        depth -= 1
+        if depth == 0:
+          pieces.append(chunk[piece_start:pos])
+          yield record_start, ''.join(pieces)
+          pieces = []
+    if depth > 0:
+      pieces.append(chunk[piece_start:])
+    offset += len(chunk)
+  if depth > 0:
+    raise ValueError('Unexpected end of file in LispTree at byte %d' % record_start)
+
+def _parse_record(text):
+  """Parse a tree read from a file, which may span several lines.
+
+  from_string() only separates tokens by spaces, so newlines and tabs
+  outside of quotes are turned into spaces first.
+  """
+  if '\n' in text or '\t' in text or '\r' in text:
+    text = _LINE_BREAK_RE.sub(lambda m: m.group(1) or ' ', text)
+  return from_string(text)
+
+def iter_lisptrees(f, chunk_size=READ_CHUNK_SIZE):
+  """Lazily parse the top-level LispTrees of a file, one at a time.
+
+  Trees may span several lines, as fig writes them.
+
+  Args:
+    f: a file object (opened in binary mode) or a filename.
+    chunk_size: number of bytes to read at a time.
+  """
+  if isinstance(f, basestring):
+    with open(f, 'rb') as fileobj:
+      for tree in iter_lisptrees(fileobj, chunk_size=chunk_size):
+        yield tree
+    return
+  for offset, text in _iter_records(f, chunk_size=chunk_size):
+    yield _parse_record(text)
+
+def build_index(filename):
+  """Return an array of the byte offset of each top-level tree in a file."""
+  with open(filename, 'rb') as f:
+    return np.array([offset for offset, text in _iter_records(f)],
+                    dtype=np.int64)
+
+def _parse_shard(args):
+  filename, start, end, func = args
+  trees = []
+  with open(filename, 'rb') as f:
+    f.seek(start)
+    for offset, text in _iter_records(f, end=end):
+      tree = _parse_record(text)
+      trees.append(func(tree) if func else tree)
+  return trees
+
+class LispTreeFile(object):
+  """Random access to the top-level LispTrees of a file.
+
+  A byte-offset index of the trees is built on first use and, if
+  index_file is given, saved there and reused while it is newer than
+  the file.
+
+  Example:
+    trees = LispTreeFile('examples.lisp', index_file='examples.lisp.idx')
+    print len(trees), trees[1000]
+    for formula in trees.parallel_imap(get_formula):
+      ...
+  """
+  def __init__(self, filename, index_file=None):
+    self.filename = filename
+    self.index_file = index_file
+    if (index_file and os.path.exists(index_file) and
+        os.path.getmtime(index_file) >= os.path.getmtime(filename)):
+      with open(index_file, 'rb') as f:
+        self.offsets = np.load(f)
+    else:
+      self.offsets = build_index(filename)
+      if index_file:
+        with open(index_file, 'wb') as f:
+          np.save(f, self.offsets)
+    self._file = None
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __getitem__(self, k):
+    """Parse the k-th tree (negative k counts from the end)."""
+    if k < 0:
+      k += len(self)
+    if not 0 <= k < len(self):
+      raise IndexError('LispTree index out of range')
+    if self._file is None:
+      self._file = open(self.filename, 'rb')
+    self._file.seek(self.offsets[k])
+    end = self.offsets[k + 1] if k + 1 < len(self.offsets) else None
+    for offset, text in _iter_records(self._file, chunk_size=1 << 16, end=end):
+      return _parse_record(text)
+
+  def __iter__(self):
+    return iter_lisptrees(self.filename)
+
+  def _shards(self, num_shards):
+    size = os.path.getsize(self.filename)
+    bounds = np.linspace(0, len(self.offsets), num_shards + 1).astype(np.int64)
+    starts = [int(self.offsets[i]) if i < len(self.offsets) else size
+              for i in bounds]
+    return [(starts[i], starts[i + 1]) for i in range(num_shards)
+            if bounds[i] < bounds[i + 1]]
+
+  def parallel_imap(self, func=None, num_procs=None, num_shards=None):
+    """Lazily parse all trees across processes, optionally mapping func.
+
+    Each worker streams its shard of the file, and only a few shards'
+    results are held in memory at a time.
+
+    Args:
+      func: if provided, a picklable function applied to each tree in the
+          worker, which avoids sending whole trees between processes.
+      num_procs: number of worker processes (default = number of CPUs).
+      num_shards: number of pieces to split the file into (default =
+          4 per process, or more to keep each under MAX_SHARD_SIZE bytes).
+    Yields:
+      Trees (or func's results), in file order.
+    """
+    if not num_shards:
+      num_shards = max(4 * (num_procs or multiprocessing.cpu_count()),
+                       -(-os.path.getsize(self.filename) // MAX_SHARD_SIZE))
+    shards = [(self.filename, start, end, func)
+              for start, end in self._shards(num_shards)]
+    for trees in parallel_imap(_parse_shard, shards, num_procs=num_procs,
+                               chunksize=1, min_parallel=2):
+      for tree in trees:
+        yield tree
+
+  def parallel_map(self, func=None, num_procs=None, num_shards=None):
+    """Like parallel_imap(), but return a list."""
+    return list(self.parallel_imap(func, num_procs=num_procs,
+                                   num_shards=num_shards))
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
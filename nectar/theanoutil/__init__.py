@@ -1,5 +1,8 @@
 from args import *
 from model import *
+import batching
+import dataset
+from metrics import *
 import rnn
 import treelstm
 from util import *
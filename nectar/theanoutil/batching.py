@@ -0,0 +1,146 @@
+"""Utilities for grouping examples into minibatches."""
+import numpy as np
+import Queue
+import sys
+import threading
+
+BUCKET_BATCHES = 50  # Batches per bucket when grouping by length
+
+def pad_sequences(seqs, pad_value=0, dtype=np.int32, mask_dtype=np.float32,
+                  time_major=False):
+  """Pad sequences of different lengths into a single array.
+
+  Args:
+    seqs: a list of sequences (e.g. lists of word indices).
+    pad_value: value for positions past the end of a sequence.
+    dtype: dtype of the padded array.
+    mask_dtype: dtype of the mask.
+    time_major: if True, return arrays of shape (max_len, batch_size),
+        as used by theano.scan(); else (batch_size, max_len).
+  Returns:
+    (padded, mask), where mask is 1 at real positions and 0 at padding.
+  """
+  lens = [len(s) for s in seqs]
+  max_len = max(lens) if lens else 0
+  padded = np.full((len(seqs), max_len), pad_value, dtype=dtype)
+  mask = np.zeros((len(seqs), max_len), dtype=mask_dtype)
+  for i, (s, n) in enumerate(zip(seqs, lens)):
+    padded[i, :n] = s
+    mask[i, :n] = 1
+  if time_major:
+    return padded.T, mask.T
+  return padded, mask
+
+def default_collate(examples):
+  """The default collate function: a batch is just a list of examples."""
+  return examples
+
+def make_batches(examples, batch_size, rng=None, length_fn=None,
+                 bucket_batches=BUCKET_BATCHES):
+  """Split examples into lists of at most batch_size examples.
+
+  Args:
+    examples: a list of examples.
+    batch_size: maximum number of examples per batch.
+    rng: if provided, a random.Random (or the random module) used to
+        shuffle the examples and the order of the batches.
+    length_fn: if provided, a function giving the length of an example.
+        Examples are then grouped with others of similar length, to
+        minimize padding: each run of bucket_batches * batch_size
+        (shuffled) examples is sorted by length before being split.
+    bucket_batches: number of batches per bucket, with length_fn.
+  Returns:
+    A list of lists of examples.
+  """
+  examples = list(examples)
+  if rng:
+    rng.shuffle(examples)
+  if length_fn:
+    bucket_size = batch_size * bucket_batches
+    buckets = [sorted(examples[i:i + bucket_size], key=length_fn)
+               for i in range(0, len(examples), bucket_size)]
+  else:
+    buckets = [examples]
+  batches = [b[i:i + batch_size] for b in buckets
+             for i in range(0, len(b), batch_size)]
+  if rng and length_fn:
+    # Otherwise batches would go from short to long within each bucket
+    rng.shuffle(batches)
+  return batches
+
+def iter_batches(examples, batch_size, rng=None, length_fn=None,
+                 bucket_batches=BUCKET_BATCHES):
+  """Like make_batches(), but lazily, for a stream of examples.
+
+  Only one bucket of examples is held in memory at a time.  The examples
+  are not shuffled (the stream should already be), but with rng and
+  length_fn, the batches within each bucket are.
+  """
+  bucket_size = batch_size * bucket_batches if length_fn else batch_size
+  bucket = []
+  def split(bucket):
+    if length_fn:
+      bucket.sort(key=length_fn)
+    batches = [bucket[i:i + batch_size]
+               for i in range(0, len(bucket), batch_size)]
+    if rng and length_fn:
+      rng.shuffle(batches)
+    return batches
+  for ex in examples:
+    bucket.append(ex)
+    if len(bucket) == bucket_size:
+      for batch in split(bucket):
+        yield batch
+      bucket = []
+  for batch in split(bucket):
+    yield batch
+
+_ITEM = 'item'
+_DONE = 'done'
+_ERROR = 'error'
+
+def _fill_queue(it, q, stopped):
+  def put(msg):
+    while not stopped.is_set():
+      try:
+        q.put(msg, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+  try:
+    for x in it:
+      if not put((_ITEM, x)): return
+    put((_DONE, None))
+  except Exception:
+    put((_ERROR, sys.exc_info()))
+
+def prefetch(iterable, num_prefetch=4):
+  """Iterate over iterable, computing up to num_prefetch items ahead.
+
+  Items are computed in a background thread, in order, so that preparing
+  the next batches (e.g. collating and padding) overlaps with running
+  theano functions, which release the GIL.  Exceptions raised by the
+  iterable are re-raised here.  The thread is stopped when the returned
+  generator is exhausted, closed or garbage collected.
+  """
+  q = Queue.Queue(maxsize=num_prefetch)
+  stopped = threading.Event()
+  t = threading.Thread(target=_fill_queue, args=(iter(iterable), q, stopped))
+  t.daemon = True
+  t.start()
+  try:
+    while True:
+      try:
+        # Timeout lets KeyboardInterrupt through on Python 2
+        kind, value = q.get(timeout=1.0)
+      except Queue.Empty:
+        continue
+      if kind == _DONE:
+        return
+      if kind == _ERROR:
+        raise value[0], value[1], value[2]
+      yield value
+  finally:
+    stopped.set()
+    t.join()
@@ -0,0 +1,138 @@
+"""Datasets stored on disk as shards of packed numpy arrays.
+
+Each example is a tuple of fields, where each field is a sequence of
+integers (e.g. word indices) or a single number (e.g. a label).  A shard
+file holds many examples: for each field, either all values in one array
+or all sequences concatenated into one array plus an array of offsets.
+
+A ShardedDataset streams examples one shard at a time, so only one shard
+(plus the shuffle buffer) is ever held in memory.  It can be passed to
+TheanoModel.train() in place of a list.
+
+Example:
+  write_shards(((indexify(q), label) for q, label in data), 'train', 100000)
+  dataset = ShardedDataset(glob.glob('train-*.npz'))
+  model.train(dataset, 0.1, 10)
+"""
+import numpy as np
+
+DEFAULT_SHUFFLE_BUFFER = 10000
+
+def _save_shard(filename, examples, dtype):
+  arrays = {}
+  for j in range(len(examples[0])):
+    values = [ex[j] for ex in examples]
+    if np.isscalar(values[0]):
+      arrays['f%d_values' % j] = np.array(values)
+    else:
+      lens = [len(v) for v in values]
+      offsets = np.zeros(len(values) + 1, dtype=np.int64)
+      np.cumsum(lens, out=offsets[1:])
+      arrays['f%d_offsets' % j] = offsets
+      if offsets[-1]:
+        arrays['f%d_data' % j] = np.concatenate(values).astype(dtype)
+      else:
+        arrays['f%d_data' % j] = np.zeros(0, dtype=dtype)
+  with open(filename, 'wb') as f:
+    np.savez(f, num_fields=len(examples[0]), **arrays)
+
+def write_shards(examples, prefix, shard_size=100000, dtype=np.int32):
+  """Write examples to shard files named '%s-%05d.npz' % (prefix, i).
+
+  Args:
+    examples: an iterable of examples, each a tuple of fields.
+    prefix: prefix of the shard filenames.
+    shard_size: number of examples per shard.
+    dtype: dtype for storing sequence fields.
+  Returns:
+    The list of shard filenames.
+  """
+  filenames = []
+  cur = []
+  def flush():
+    filename = '%s-%05d.npz' % (prefix, len(filenames))
+    _save_shard(filename, cur, dtype)
+    filenames.append(filename)
+  for ex in examples:
+    cur.append(ex)
+    if len(cur) == shard_size:
+      flush()
+      cur = []
+  if cur:
+    flush()
+  return filenames
+
+def read_shard(filename):
+  """Return the list of examples in a shard file."""
+  with np.load(filename) as d:
+    columns = []
+    for j in range(int(d['num_fields'])):
+      if 'f%d_values' % j in d:
+        columns.append(d['f%d_values' % j])
+      else:
+        data = d['f%d_data' % j]
+        offsets = d['f%d_offsets' % j]
+        columns.append([data[offsets[i]:offsets[i + 1]]
+                        for i in range(len(offsets) - 1)])
+  return zip(*columns)
+
+def _shard_len(filename):
+  with np.load(filename) as d:
+    if 'f0_values' in d:
+      return len(d['f0_values'])
+    return len(d['f0_offsets']) - 1
+
+class ShardedDataset(object):
+  """A dataset streamed from shard files written by write_shards()."""
+  def __init__(self, filenames, shuffle_buffer=DEFAULT_SHUFFLE_BUFFER):
+    """Create the dataset.
+
+    Args:
+      filenames: list of shard files.
+      shuffle_buffer: number of examples held in memory for shuffling.
+    """
+    self.filenames = sorted(filenames)
+    self.shuffle_buffer = shuffle_buffer
+    self._len = None
+
+  def __len__(self):
+    if self._len is None:
+      self._len = sum(_shard_len(f) for f in self.filenames)
+    return self._len
+
+  def __iter__(self):
+    """Iterate over all examples in order."""
+    for filename in self.filenames:
+      for ex in read_shard(filename):
+        yield ex
+
+  def iter_epoch(self, rng=None):
+    """Iterate over all examples for one training epoch.
+
+    The shards are read in a random order, and examples are shuffled
+    through a buffer of self.shuffle_buffer examples.  This only
+    approximates a full shuffle, so shards should not be sorted by
+    label, length, etc.
+
+    Args:
+      rng: a random.Random (or the random module); if None, iterate
+          in order.
+    """
+    if rng is None:
+      for ex in self:
+        yield ex
+      return
+    filenames = list(self.filenames)
+    rng.shuffle(filenames)
+    buf = []
+    for filename in filenames:
+      for ex in read_shard(filename):
+        if len(buf) < self.shuffle_buffer:
+          buf.append(ex)
+        else:
+          i = rng.randrange(len(buf))
+          yield buf[i]
+          buf[i] = ex
+    rng.shuffle(buf)
+    for ex in buf:
+      yield ex
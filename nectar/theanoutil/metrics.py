@@ -0,0 +1,98 @@
+"""Streaming aggregation of weighted metrics."""
+import collections
+import numpy as np
+
+class MetricAccumulator(object):
+  """Accumulates weighted averages of metrics, one dict at a time.
+
+  Each added dict maps metric_name to (value, weight), as returned by
+  TheanoModel.train_one() and get_metrics().  Memory is O(1) in the number
+  of dicts added, and accumulators from different workers can be merged.
+
+  Example:
+    acc = MetricAccumulator()
+    for ex in dataset:
+      acc.add(model.get_metrics(ex))
+    print acc.get()
+  """
+  def __init__(self, track_range=False, histogram_edges=None):
+    """Create the accumulator.
+
+    Args:
+      track_range: if True, also track the min and max value of each metric.
+      histogram_edges: if provided, a sorted list of bin edges; also track
+          the total weight of values falling in each bin (values outside
+          the edges are counted in the first or last bin).
+    """
+    self.track_range = track_range
+    self.histogram_edges = histogram_edges
+    self.numers = collections.OrderedDict()
+    self.denoms = {}
+    self.mins = {}
+    self.maxes = {}
+    self.histograms = {}
+    self.count = 0
+
+  def add(self, metrics):
+    """Add one dict mapping metric_name to (value, weight)."""
+    self.count += 1
+    for k, (value, weight) in metrics.iteritems():
+      if k in self.numers:
+        self.numers[k] += value * weight
+        self.denoms[k] += weight
+      else:
+        # Start from 0, so sums match aggregate_metrics() exactly
+        self.numers[k] = 0 + value * weight
+        self.denoms[k] = 0 + weight
+      if self.track_range:
+        if k not in self.mins or value < self.mins[k]:
+          self.mins[k] = value
+        if k not in self.maxes or value > self.maxes[k]:
+          self.maxes[k] = value
+      if self.histogram_edges is not None:
+        if k not in self.histograms:
+          self.histograms[k] = np.zeros(max(len(self.histogram_edges) - 1, 1))
+        i = np.searchsorted(self.histogram_edges, value, side='right') - 1
+        self.histograms[k][min(max(i, 0), len(self.histograms[k]) - 1)] += weight
+
+  def merge(self, other):
+    """Add everything accumulated by another MetricAccumulator."""
+    self.count += other.count
+    for k, numer in other.numers.iteritems():
+      if k in self.numers:
+        self.numers[k] += numer
+        self.denoms[k] += other.denoms[k]
+      else:
+        self.numers[k] = numer
+        self.denoms[k] = other.denoms[k]
+    for k, v in other.mins.iteritems():
+      if k not in self.mins or v < self.mins[k]:
+        self.mins[k] = v
+    for k, v in other.maxes.iteritems():
+      if k not in self.maxes or v > self.maxes[k]:
+        self.maxes[k] = v
+    for k, hist in other.histograms.iteritems():
+      if k in self.histograms:
+        self.histograms[k] = self.histograms[k] + hist
+      else:
+        self.histograms[k] = hist.copy()
+
+  def get(self):
+    """Return an OrderedDict mapping metric_name to its weighted average."""
+    return collections.OrderedDict(
+        (k, float(numer) / self.denoms[k]) for k, numer in self.numers.iteritems())
+
+  def get_stats(self, k):
+    """Return a dict of everything tracked for metric k."""
+    stats = {'mean': float(self.numers[k]) / self.denoms[k],
+             'weight': self.denoms[k]}
+    if k in self.mins:
+      stats['min'] = self.mins[k]
+      stats['max'] = self.maxes[k]
+    if k in self.histograms:
+      stats['histogram'] = self.histograms[k]
+    return stats
+
+  def __len__(self):
+    """The number of metric dicts added."""
+    return self.count
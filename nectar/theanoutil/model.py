@@ -1,16 +1,23 @@
 """Standard utilties for a theano model."""
 import collections
+import contextlib
+import multiprocessing
 import numbers
 import numpy as np
+import os
 import pickle
 import random
+import shutil
 import sys
+import tempfile
 import theano
 import time
 from Tkinter import TclError
 
 import __init__ as ntu
-from .. import log, secs_to_str
+import batching
+from metrics import MetricAccumulator
+from .. import buffered_log, log, secs_to_str
 
 class TheanoModel(object):
   """A generic theano model.
@@ -103,12 +110,53 @@ class TheanoModel(object):
     self.param_list.append(mat)
     self.param_names.append(name)
 
+  def _iter_inputs(self, data, batch_size=None, collate_fn=None, rng=None,
+                   length_fn=None, num_prefetch=0, with_sizes=False):
+    """Return an iterator over what to pass to train_one() or get_metrics().
+
+    Without batch_size, these are the examples themselves (shuffled in
+    place if rng is given); otherwise, collate_fn applied to each batch.
+    With with_sizes, yield (input, number of examples in it) pairs instead.
+    Shuffling happens here, in the calling thread, so it is deterministic
+    even when the inputs are prepared in the background (num_prefetch > 0).
+    """
+    if hasattr(data, 'iter_epoch'):
+      # A streaming dataset (e.g. dataset.ShardedDataset).  Seed its own
+      # rng from this thread, as it will be used wherever data is read.
+      if rng:
+        rng = random.Random(rng.randint(0, sys.maxint))
+      inputs = data.iter_epoch(rng)
+      if batch_size:
+        collate_fn = collate_fn or batching.default_collate
+        inputs = ((collate_fn(b), len(b)) for b in batching.iter_batches(
+            inputs, batch_size, rng=rng, length_fn=length_fn))
+      else:
+        inputs = ((ex, 1) for ex in inputs)
+    elif not batch_size:
+      if rng:
+        rng.shuffle(data)
+      inputs = ((ex, 1) for ex in data)
+    else:
+      collate_fn = collate_fn or batching.default_collate
+      batches = batching.make_batches(data, batch_size, rng=rng,
+                                      length_fn=length_fn)
+      inputs = ((collate_fn(b), len(b)) for b in batches)
+    if not with_sizes:
+      inputs = (x for x, n in inputs)
+    if num_prefetch:
+      inputs = batching.prefetch(inputs, num_prefetch)
+    return inputs
+
   def train(self, train_data, lr_init, epochs, dev_data=None, rng_seed=0,
-            plot_metric=None, plot_outfile=None):
+            plot_metric=None, plot_outfile=None, batch_size=None,
+            collate_fn=None, length_fn=None, num_prefetch=0, report_every=None,
+            dev_num_procs=None):
     """Train the model.
 
     Args:
-      train_data: A list of training examples
+      train_data: A list of training examples, or a dataset too large for
+          memory that streams examples with iter_epoch(rng),
+          e.g. a dataset.ShardedDataset.
       lr_init: Initial learning rate
       epochs: An integer number of epochs to train, or a list of integers, 
           where we halve the learning rate after each period.
@@ -116,9 +164,27 @@ class TheanoModel(object):
       rng_seed: Random seed for shuffling the dataset at each epoch.
       plot_metric: If True, plot a learning for the given metric.
       plot_outfile: If provided, save learning curve to file.
+      batch_size: If provided, train_one() and get_metrics() are called on
+          batches of up to this many examples, instead of single examples.
+          Their metric weights should then count the examples in the batch.
+      collate_fn: With batch_size, a function that turns a list of
+          examples into what train_one() expects (default = the list).
+          See batching.pad_sequences() for padding and masks.
+      length_fn: With batch_size, a function giving the length of an
+          example; batches then group examples of similar length.
+      num_prefetch: If positive, prepare up to this many inputs (e.g.
+          collated batches) ahead in a background thread, while the
+          model runs on the current one.
+      report_every: If provided, also log the running train metrics of
+          the current epoch after every this many training examples
+          (rounded up to whole batches, with batch_size).
+      dev_num_procs: If more than 1, evaluate on dev_data with this many
+          worker processes (see evaluate()).  The workers are started
+          once, and receive the current parameters before each dev pass.
     """
     random.seed(rng_seed)
-    train_data = list(train_data)
+    if not hasattr(train_data, 'iter_epoch'):
+      train_data = list(train_data)
     lr = lr_init
     if isinstance(epochs, numbers.Number):
       lr_changes = []
@@ -131,38 +197,52 @@ class TheanoModel(object):
     dev_plot_list = []
     str_len_dict = collections.defaultdict(int)
     len_time = 0
-    for epoch in range(num_epochs):
-      t0 = time.time()
-      random.shuffle(train_data)
-      if epoch in lr_changes:
-        lr *= 0.5
-      train_metric_list = []
-      for ex in train_data:
-        cur_metrics = self.train_one(ex, lr)
-        train_metric_list.append(cur_metrics)
-      if dev_data:
-        dev_metric_list = [self.get_metrics(ex) for ex in dev_data]
-      else:
-        dev_metric_list = []
-      t1 = time.time()
-
-      # Compute the averaged metrics
-      train_metrics = aggregate_metrics(train_metric_list)
-      dev_metrics = aggregate_metrics(dev_metric_list)
-      if plot_metric:
-        train_plot_list.append(train_metrics[plot_metric])
-        if dev_metrics:
-          dev_plot_list.append(dev_metrics[plot_metric])
-
-      # Some formatting to make things align in columns
-      train_str = format_epoch_str('train', train_metrics, str_len_dict)
-      dev_str = format_epoch_str('dev', dev_metrics, str_len_dict)
-      metric_str = ', '.join(x for x in [train_str, dev_str] if x)
-      time_str = secs_to_str(t1 - t0)
-      len_time = max(len(time_str), len_time)
-      log('Epoch %s: %s [lr = %.1e] [took %s]' % (
-          str(epoch+1).rjust(num_epochs_digits), metric_str, lr,
-          time_str.rjust(len_time)))
+    dev_procs = dev_num_procs if dev_data else None
+    with buffered_log(), self._eval_pool(dev_procs) as eval_pool:
+      for epoch in range(num_epochs):
+        t0 = time.time()
+        if epoch in lr_changes:
+          lr *= 0.5
+        train_acc = MetricAccumulator()
+        num_examples = 0
+        for ex, n in self._iter_inputs(train_data, batch_size, collate_fn,
+                                       rng=random, length_fn=length_fn,
+                                       num_prefetch=num_prefetch,
+                                       with_sizes=True):
+          train_acc.add(self.train_one(ex, lr))
+          num_reports = num_examples // report_every if report_every else 0
+          num_examples += n
+          if report_every and num_examples // report_every > num_reports:
+            log('Epoch %s [%d examples]: %s' % (
+                str(epoch+1).rjust(num_epochs_digits), num_examples,
+                format_epoch_str('train', train_acc.get(), str_len_dict)))
+        if dev_data and eval_pool:
+          dev_acc = eval_pool.evaluate(self, dev_data, batch_size, collate_fn,
+                                       length_fn)
+        elif dev_data:
+          dev_acc = self._evaluate_acc(dev_data, batch_size, collate_fn,
+                                       length_fn, num_prefetch)
+        else:
+          dev_acc = MetricAccumulator()
+        t1 = time.time()
+
+        # Compute the averaged metrics
+        train_metrics = train_acc.get()
+        dev_metrics = dev_acc.get()
+        if plot_metric:
+          train_plot_list.append(train_metrics[plot_metric])
+          if dev_metrics:
+            dev_plot_list.append(dev_metrics[plot_metric])
+
+        # Some formatting to make things align in columns
+        train_str = format_epoch_str('train', train_metrics, str_len_dict)
+        dev_str = format_epoch_str('dev', dev_metrics, str_len_dict)
+        metric_str = ', '.join(x for x in [train_str, dev_str] if x)
+        time_str = secs_to_str(t1 - t0)
+        len_time = max(len(time_str), len_time)
+        log('Epoch %s: %s [lr = %.1e] [took %s]' % (
+            str(epoch+1).rjust(num_epochs_digits), metric_str, lr,
+            time_str.rjust(len_time)))
 
     if plot_metric:
       plot_data = [('%s on train data' % plot_metric, train_plot_list)]
@@ -174,10 +254,44 @@ class TheanoModel(object):
         print >> sys.stderr, 'Encoutered error while plotting learning curve'
 
 
-  def evaluate(self, dataset):
-    """Evaluate the model."""
-    metrics_list = [self.get_metrics(ex) for ex in dataset]
-    return aggregate_metrics(metrics_list)
+  def _evaluate_acc(self, dataset, batch_size=None, collate_fn=None,
+                    length_fn=None, num_prefetch=0):
+    """Run get_metrics() over a dataset; return a MetricAccumulator."""
+    acc = MetricAccumulator()
+    for ex in self._iter_inputs(dataset, batch_size, collate_fn,
+                                length_fn=length_fn, num_prefetch=num_prefetch):
+      acc.add(self.get_metrics(ex))
+    return acc
+
+  @contextlib.contextmanager
+  def _eval_pool(self, num_procs):
+    """Context manager for an _EvalPool, or None if num_procs <= 1."""
+    if not num_procs or num_procs <= 1:
+      yield None
+      return
+    pool = _EvalPool(self, num_procs)
+    try:
+      yield pool
+    finally:
+      pool.close()
+
+  def evaluate(self, dataset, batch_size=None, collate_fn=None, length_fn=None,
+               num_prefetch=0, num_procs=None):
+    """Evaluate the model, optionally on batches as in train().
+
+    If num_procs is more than 1, the model is saved with save(), and each
+    of num_procs worker processes loads it with load() and evaluates
+    shards of the dataset.  The workers' MetricAccumulators are merged,
+    so the result is the same weighted average as a serial evaluation.
+    collate_fn and length_fn must then be picklable (module-level).
+    """
+    with self._eval_pool(num_procs) as pool:
+      if pool:
+        acc = pool.evaluate(self, dataset, batch_size, collate_fn, length_fn)
+      else:
+        acc = self._evaluate_acc(dataset, batch_size, collate_fn, length_fn,
+                                 num_prefetch)
+    return acc.get()
 
   def save(self, filename):
     # Save
@@ -230,15 +344,78 @@ class TheanoModel(object):
     """Any additional things after calling pickle.load()."""
     pass
 
+_EVAL_MODEL = None  # The model held by each _EvalPool worker
+_EVAL_PARAMS_VERSION = None
+
+def _init_eval_worker(cls, model_file):
+  global _EVAL_MODEL
+  _EVAL_MODEL = cls.load(model_file)
+
+def _eval_shard(args):
+  global _EVAL_PARAMS_VERSION
+  param_file, version, shard, batch_size, collate_fn, length_fn = args
+  if version != _EVAL_PARAMS_VERSION:
+    with open(param_file, 'rb') as f:
+      values = np.load(f)
+      for name in _EVAL_MODEL.param_names:
+        _EVAL_MODEL.params[name].set_value(values[name])
+    _EVAL_PARAMS_VERSION = version
+  return _EVAL_MODEL._evaluate_acc(shard, batch_size, collate_fn, length_fn)
+
+def _split_dataset(dataset, num_shards):
+  """Split a dataset into at most num_shards contiguous pieces."""
+  if hasattr(dataset, 'filenames'):
+    # A ShardedDataset: split by file, so workers read the files themselves
+    files = dataset.filenames
+    bounds = np.linspace(0, len(files), min(num_shards, len(files)) + 1)
+    return [type(dataset)(files[int(a):int(b)])
+            for a, b in zip(bounds[:-1], bounds[1:])]
+  dataset = list(dataset)
+  bounds = np.linspace(0, len(dataset), min(num_shards, len(dataset)) + 1)
+  return [dataset[int(a):int(b)] for a, b in zip(bounds[:-1], bounds[1:])]
+
+class _EvalPool(object):
+  """Worker processes that each load a copy of a model, for evaluation.
+
+  Only parameter values are sent to the workers on each evaluate() call;
+  anything else about the model must not change after the pool starts.
+  """
+  def __init__(self, model, num_procs):
+    self.num_procs = num_procs
+    self.tmp_dir = tempfile.mkdtemp()
+    model_file = os.path.join(self.tmp_dir, 'model.pkl')
+    model.save(model_file)
+    self.param_file = os.path.join(self.tmp_dir, 'params.npz')
+    self.version = 0
+    self.pool = multiprocessing.Pool(num_procs, _init_eval_worker,
+                                     (type(model), model_file))
+
+  def evaluate(self, model, dataset, batch_size=None, collate_fn=None,
+               length_fn=None):
+    """Evaluate model's current parameters; return a MetricAccumulator."""
+    self.version += 1
+    with open(self.param_file, 'wb') as f:
+      np.savez(f, **dict((k, v.get_value()) for k, v in model.params.iteritems()))
+    # Several shards per worker, for load balancing
+    shards = _split_dataset(dataset, 4 * self.num_procs)
+    tasks = [(self.param_file, self.version, shard, batch_size, collate_fn,
+              length_fn) for shard in shards]
+    acc = MetricAccumulator()
+    # imap() returns results in order, so they are merged deterministically
+    for shard_acc in self.pool.imap(_eval_shard, tasks):
+      acc.merge(shard_acc)
+    return acc
+
+  def close(self):
+    self.pool.terminate()
+    self.pool.join()
+    shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
 def aggregate_metrics(metric_list):
-  metrics = collections.OrderedDict()
-  if metric_list: 
-    keys = metric_list[0].keys()
-    for k in keys:
-      numer = sum(x[k][0] * x[k][1] for x in metric_list)
-      denom = sum(x[k][1] for x in metric_list)
-      metrics[k] = float(numer) / denom
-  return metrics
+  acc = MetricAccumulator()
+  for metrics in metric_list:
+    acc.add(metrics)
+  return acc.get()
 
 def format_epoch_str(name, metrics, str_len_dict):
   if not metrics: return ''
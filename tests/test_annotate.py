@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Tests of nectar.corenlp.annotate against a stub CoreNLP HTTP server.
+
+Run with: python -m unittest discover tests
+"""
+import BaseHTTPServer
+import json
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+from nectar.corenlp import annotate
+from nectar.corenlp.client import CoreNLPClient
+
+class StubCoreNLPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Tokenizes on spaces, one sentence per line, and tags everything NN."""
+  protocol_version = 'HTTP/1.1'
+  requests = []
+
+  def log_message(self, *args):
+    pass
+
+  def do_POST(self):
+    length = int(self.headers.getheader('content-length'))
+    text = self.rfile.read(length).decode('utf-8')
+    StubCoreNLPHandler.requests.append(text)
+    sentences = []
+    offset = 0
+    for line in text.split('\n'):
+      tokens = []
+      pos = offset
+      for word in line.split(' '):
+        if word:
+          tokens.append({'index': len(tokens) + 1, 'word': word,
+                         'originalText': word, 'pos': 'NN',
+                         'characterOffsetBegin': pos,
+                         'characterOffsetEnd': pos + len(word)})
+        pos += len(word) + 1
+      offset += len(line) + 1
+      if tokens:
+        sentences.append({'index': len(sentences), 'tokens': tokens})
+    body = json.dumps({'sentences': sentences})
+    self.send_response(200)
+    self.send_header('Content-Length', len(body))
+    self.end_headers()
+    self.wfile.write(body)
+
+class StubCoreNLPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+class AnnotateTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.server = StubCoreNLPServer(('127.0.0.1', 0), StubCoreNLPHandler)
+    cls.port = cls.server.server_address[1]
+    t = threading.Thread(target=cls.server.serve_forever)
+    t.daemon = True
+    t.start()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+    cls.server.server_close()
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.in_file = os.path.join(self.tmp_dir, 'in.txt')
+    self.out_file = os.path.join(self.tmp_dir, 'out.jsonl')
+    self.client = CoreNLPClient(port=self.port, max_concurrency=4)
+    self.properties = annotate.parse_properties('tokenize,ssplit,pos', [])
+    del StubCoreNLPHandler.requests[:]
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def write_input(self, lines):
+    with open(self.in_file, 'w') as f:
+      for line in lines:
+        f.write(line.encode('utf-8') + '\n')
+
+  def read_output(self):
+    with open(self.out_file) as f:
+      return [json.loads(line) for line in f]
+
+  def test_annotate_lines(self):
+    lines = [u'Doc number %d .' % i for i in range(20)]
+    self.write_input(lines)
+    n = annotate.annotate_file(self.client, self.in_file, self.out_file,
+                               self.properties)
+    self.assertEqual(n, 20)
+    records = self.read_output()
+    self.assertEqual([r['text'] for r in records], lines)
+    self.assertEqual([t['word'] for t in records[3]['corenlp']['sentences'][0]['tokens']],
+                     [u'Doc', u'number', u'3', u'.'])
+
+  def test_non_ascii(self):
+    lines = [u'café ok', u'naïve über straße']
+    self.write_input(lines)
+    annotate.annotate_file(self.client, self.in_file, self.out_file,
+                           self.properties)
+    records = self.read_output()
+    self.assertEqual([r['text'] for r in records], lines)
+    self.assertEqual([t['word'] for t in records[0]['corenlp']['sentences'][0]['tokens']],
+                     [u'café', u'ok'])
+
+  def test_jsonl(self):
+    with open(self.in_file, 'w') as f:
+      f.write(json.dumps({'id': 1, 'body': u'Hello wörld .'}) + '\n')
+      f.write(json.dumps({'id': 2, 'body': u'Bye .'}) + '\n')
+    annotate.annotate_file(self.client, self.in_file, self.out_file,
+                           self.properties, input_format=annotate.FORMAT_JSONL,
+                           text_field='body')
+    records = self.read_output()
+    self.assertEqual([r['id'] for r in records], [1, 2])
+    self.assertEqual(len(records[0]['corenlp']['sentences'][0]['tokens']), 3)
+
+  def test_resume(self):
+    lines = [u'Doc number %d .' % i for i in range(30)]
+    self.write_input(lines)
+    annotate.annotate_file(self.client, self.in_file, self.out_file,
+                           self.properties)
+    with open(self.out_file) as f:
+      full = f.read()
+    # Simulate a job killed while writing line 10
+    out_lines = full.split('\n')
+    with open(self.out_file, 'w') as f:
+      f.write('\n'.join(out_lines[:10]) + '\n' + out_lines[10][:15])
+    del StubCoreNLPHandler.requests[:]
+    n = annotate.annotate_file(self.client, self.in_file, self.out_file,
+                               self.properties)
+    self.assertEqual(n, 20)
+    self.assertEqual(len(StubCoreNLPHandler.requests), 20)
+    with open(self.out_file) as f:
+      self.assertEqual(f.read(), full)
+
+if __name__ == '__main__':
+  unittest.main()